@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+
+"""
+Compare netCDF compression/chunking settings for the generated met files:
+time to write, disk footprint and time to read the file back the way CABLE
+does. CABLE's met reader steps through the whole record one timestep at a
+time, reading each met variable for that timestep with its own
+nf90_get_var call, so that is what we time: every variable, every
+timestep, in order. It goes through the same netCDF-C library as CABLE,
+but from python, which adds a fixed cost per call, so use the read times
+to compare the profiles rather than as CABLE's own read time. Expect this
+to take a while for a long transient file.
+
+Run it on the filesystem the model will actually read from (e.g. Lustre),
+as that is what matters. Note the read timings include whatever the OS has
+cached, so the first profile can look a little slower.
+
+Pick a profile and pass it to RunCable as "met_nc_options".
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import time
+import netCDF4 as nc
+import pandas as pd
+
+from generate_cable_met_files import GenerateMetFiles
+
+# netCDF options passed to GenerateMetFiles
+PROFILES = {
+    "default": {},
+    "time_chunked": {"time_chunk": 17520},
+    "zlib1": {"zlib": True, "complevel": 1, "shuffle": True,
+              "time_chunk": 17520},
+    "zlib4": {"zlib": True, "complevel": 4, "shuffle": True,
+              "time_chunk": 17520},
+    "zlib4_noshuffle": {"zlib": True, "complevel": 4, "shuffle": False,
+                        "time_chunk": 17520},
+    "zlib9": {"zlib": True, "complevel": 9, "shuffle": True,
+              "time_chunk": 17520},
+}
+
+def time_read(fname):
+    """
+    Read all the met (time, y, x) variables one timestep at a time over
+    the full record, as CABLE steps through the file
+    """
+    ds = nc.Dataset(fname)
+    met_vars = [ds.variables[v] for v in ds.variables \
+                    if ds.variables[v].dimensions[0:1] == ("time",) and \
+                       len(ds.variables[v].dimensions) > 1]
+    ntime = len(ds.dimensions["time"])
+
+    # raw values like CABLE gets, masking only adds to python's overhead
+    ds.set_auto_maskandscale(False)
+
+    t0 = time.time()
+    for t in range(ntime):
+        for var in met_vars:
+            var[t]
+    elapsed = time.time() - t0
+    ds.close()
+
+    return elapsed
+
+def benchmark(site, met_fname, co2_ndep_fname, out_dir, profiles=PROFILES,
+              keep=False):
+
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
+
+    results = []
+    for name, options in profiles.items():
+        ofname = os.path.join(out_dir, "%s_met_trans_%s.nc" % (site, name))
+
+        G = GenerateMetFiles(site, met_fname, co2_ndep_fname, **options)
+        t0 = time.time()
+        G.create_transient_file(ofname)
+        write_time = time.time() - t0
+
+        size = os.path.getsize(ofname) / 1024.0**2
+        read_time = time_read(ofname)
+
+        results.append([name, size, write_time, read_time])
+        print("%s: %.1f MB, write %.1f s, read (per timestep) %.1f s" % \
+                (name, size, write_time, read_time))
+
+        if not keep:
+            os.remove(ofname)
+
+    df = pd.DataFrame(results, columns=["profile", "size_mb", "write_s",
+                                        "read_s"])
+    df["size_ratio"] = df.size_mb / df.size_mb[df.profile == "default"].values[0]
+
+    return df
+
+
+if __name__ == "__main__":
+
+    #------------- Change stuff ------------- #
+    site = "AU-Tum"
+    met_dir = "met"
+    co2_ndep_dir = "co2_ndep"
+    out_dir = "met_benchmark"
+    met_fname = os.path.join(met_dir, "AU-Tum_2002-2016_OzFlux_Met.nc")
+    co2_ndep_fn = "AmaFACE_co2npdepforcing_1850_2100_AMB.csv"
+    co2_ndep_fname = os.path.join(co2_ndep_dir, co2_ndep_fn)
+    # ------------------------------------------- #
+
+    df = benchmark(site, met_fname, co2_ndep_fname, out_dir)
+    print(df.to_string(index=False))
+    print("Read times are relative, see the note at the top")
+    df.to_csv(os.path.join(out_dir, "%s_met_benchmark.csv" % (site)),
+              index=False)
@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+
+"""
+Per-call cost of editing the CABLE namelist, for the sort of replacement
+dictionary a spin phase uses:
+
+- adjust_nml_file, read, replace and write the file back
+- replace_keys, replace on text already in memory
+- Namelist, update a copy of the parsed namelist and render it
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import shutil
+import timeit
+import tempfile
+
+from cable_utils import adjust_nml_file
+from cable_utils import replace_keys
+from cable_utils import Namelist
+
+# Roughly what setup_spin changes each time
+REPLACE_DICT = {
+    "filename%restart_in": "'restart_files/AU-Tum_CNP_cable_rst_1.nc'",
+    "cable_user%climate_restart_in": "'restart_files/AU-Tum_CNP_climate_rst_1.nc'",
+    "cable_user%casa_restart_in": "'restart_files/AU-Tum_CNP_casa_rst_1.nc'",
+    "filename%restart_out": "'restart_files/AU-Tum_CNP_cable_rst_2.nc'",
+    "cable_user%climate_restart_out": "'restart_files/AU-Tum_CNP_climate_rst_2.nc'",
+    "cable_user%casa_restart_out": "'restart_files/AU-Tum_CNP_casa_rst_2.nc'",
+    "cable_user%CASA_OUT_FREQ": "'annually'",
+    "filename%out": "'outputs/AU-Tum_CNP_out_cable_spin_2.nc'",
+    "casafile%out": "'outputs/AU-Tum_CNP_out_casa_spin_2.nc'",
+    "cable_user%limit_labile": ".TRUE.",
+    "cable_user%CASA_SPIN_STARTYEAR": "2002",
+    "cable_user%CASA_SPIN_ENDYEAR": "2016",
+    "cable_user%CASA_NREP": "0",
+    "spincasa": ".FALSE.",
+    "icycle": "3",
+}
+
+def benchmark(nml_fname, number=1000):
+
+    f = open(nml_fname, 'r')
+    text = f.read()
+    f.close()
+
+    tmp_dir = tempfile.mkdtemp()
+    tmp_fname = os.path.join(tmp_dir, "cable.nml")
+    shutil.copy(nml_fname, tmp_fname)
+    base = Namelist.from_string(text)
+
+    tests = [
+        ("adjust_nml_file",
+         lambda: adjust_nml_file(tmp_fname, REPLACE_DICT)),
+        ("replace_keys",
+         lambda: replace_keys(text, REPLACE_DICT)),
+        ("Namelist.update+to_string",
+         lambda: render(base, REPLACE_DICT)),
+        ("Namelist.update+write",
+         lambda: render(base, REPLACE_DICT, tmp_fname)),
+    ]
+
+    print("%s: %d lines, %d keys" % (nml_fname, len(text.splitlines()),
+                                     len(base.index)))
+    for (name, func) in tests:
+        t = min(timeit.repeat(func, number=number, repeat=3)) / number
+        print("%-28s %8.1f us per call" % (name, t * 1E6))
+
+    shutil.rmtree(tmp_dir)
+
+def render(base, replacements, fname=None):
+    nml = base.copy()
+    nml.update(replacements)
+    if fname is None:
+        return nml.to_string()
+    nml.write(fname)
+
+
+if __name__ == "__main__":
+
+    #------------- Change stuff ------------- #
+    aux_dir = "../../src/CABLE-AUX/"
+    nml_fname = os.path.join(aux_dir, "offline/cable.nml")
+    number = 1000
+    # ------------------------------------------- #
+
+    if len(sys.argv) > 1:
+        nml_fname = sys.argv[1]
+
+    benchmark(nml_fname, number)
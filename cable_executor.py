@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+
+"""
+Run the CABLE executable: no shell, stdout/stderr captured to a log file for
+each run (and optionally echoed to the screen), an optional wall-clock
+timeout after which the run is killed, and the exit status, runtime and peak
+memory (RSS) recorded for every run.
+
+Sites (and cycles) are already run in parallel by the runners' worker
+processes, and a site's runs each start from the restart the one before
+left, so runs are made one at a time, e.g.
+
+    E = CableExecutor(timeout=3600)
+    result = E.run("./cable", "a.nml", cwd="run_a", log_fname="a_log.txt")
+    if not result.ok:
+        print(result)
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import time
+import signal
+import threading
+import subprocess
+
+
+class CableRunError(Exception):
+    pass
+
+
+class RunResult(object):
+
+    def __init__(self, cmd, log_fname, returncode, runtime, max_rss,
+                 timed_out):
+
+        self.cmd = cmd
+        self.log_fname = log_fname
+        # negative if CABLE was killed by a signal, e.g. -11 for a segfault
+        self.returncode = returncode
+        self.runtime = runtime      # seconds
+        self.max_rss = max_rss      # peak resident memory, MB
+        self.timed_out = timed_out
+
+    @property
+    def ok(self):
+        return self.returncode == 0 and not self.timed_out
+
+    def __str__(self):
+        if self.timed_out:
+            status = "timed out"
+        elif self.returncode < 0:
+            status = "killed by signal %d" % (-self.returncode)
+        else:
+            status = "exit code %d" % (self.returncode)
+
+        return "%s: %s, %.1f s, %.1f MB" % (" ".join(self.cmd), status,
+                                            self.runtime, self.max_rss)
+
+
+class CableExecutor(object):
+
+    def __init__(self, timeout=None, echo=True):
+
+        self.timeout = timeout  # seconds, None to let it run forever
+        self.echo = echo        # copy the output to the screen as well
+
+    def run(self, exe, nml_fname, cwd=None, log_fname=None, timeout=None):
+        """
+        Run CABLE with nml_fname from the dir cwd, blocking until it exits or
+        is killed for going over the timeout
+        """
+        if timeout is None:
+            timeout = self.timeout
+        if log_fname is None:
+            log_fname = os.devnull
+        cmd = [exe, nml_fname]
+
+        # CABLE gets its own process group, so a timeout takes out anything
+        # it has started too
+        log = open(log_fname, "w")
+        start = time.time()
+        if self.echo:
+            p = subprocess.Popen(cmd, cwd=cwd, stdout=subprocess.PIPE,
+                                 stderr=subprocess.STDOUT,
+                                 start_new_session=True)
+        else:
+            p = subprocess.Popen(cmd, cwd=cwd, stdout=log,
+                                 stderr=subprocess.STDOUT,
+                                 start_new_session=True)
+
+        # Kill it if it runs over. The lock stops us signalling a pid that
+        # has already been reaped (and possibly reused)
+        lock = threading.Lock()
+        state = {"finished": False, "timed_out": False}
+
+        def kill():
+            with lock:
+                if not state["finished"]:
+                    state["timed_out"] = True
+                    try:
+                        os.killpg(p.pid, signal.SIGKILL)
+                    except ProcessLookupError:
+                        # already gone, don't hide why we're killing it
+                        pass
+
+        timer = None
+        if timeout is not None:
+            timer = threading.Timer(timeout, kill)
+            timer.start()
+
+        try:
+            if self.echo:
+                for line in iter(p.stdout.readline, b""):
+                    sys.stdout.write(line.decode(errors="replace"))
+                    log.write(line.decode(errors="replace"))
+                p.stdout.close()
+
+            # wait4 rather than wait, to get the child's resource usage
+            (pid, status, rusage) = os.wait4(p.pid, 0)
+        except BaseException:
+            # e.g. ctrl-c, which CABLE no longer sees in its own group
+            kill()
+            raise
+        with lock:
+            state["finished"] = True
+        if timer is not None:
+            timer.cancel()
+        runtime = time.time() - start
+        log.close()
+
+        returncode = os.waitstatus_to_exitcode(status)
+        p.returncode = returncode
+
+        # ru_maxrss is in kilobytes on linux
+        max_rss = rusage.ru_maxrss / 1024.
+
+        return RunResult(cmd, log_fname, returncode, runtime, max_rss,
+                         state["timed_out"])
@@ -12,13 +12,14 @@ __email__ = "mdekauwe@gmail.com"
 
 import os
 import sys
+import json
+import fcntl
 import netCDF4
 import shutil
 import tempfile
+import subprocess
 import pandas as pd
-import xarray as xr
 import numpy as np
-import matplotlib.pyplot as plt
 
 def adjust_nml_file(fname, replacements):
     """
@@ -55,73 +56,279 @@ def replace_keys(text, replacements_dict):
     new_text : string
         input file with replacement values
     """
-    keys = [] # save our keys
-    lines = text.splitlines()
-    for i, row in enumerate(lines):
-        # skip blank lines
-        if not row.strip():
-            continue
-        elif "=" not in row:
-            lines[i] = row
-            continue
-        elif not row.startswith("&"):
-            key = row.split("=")[0]
-            val = row.split("=")[1]
-            lines[i] = " ".join((key.rstrip(), "=",
-                                 replacements_dict.get(key.strip(),
-                                 val.lstrip())))
-            keys.append(key.strip())
-
-    # Make sure our replacements were in the namelist to begin with, it is
-    # possible they were missing completely so we will need to add these
-    # manually
-    fix_end_statement = False
-    for key, val in replacements_dict.items():
-        if key not in keys:
-            key_to_add = " ".join((key.rstrip(), "=", val.strip()))
+    # Keys are indexed once and all the replacements are applied in a single
+    # pass, keys missing from the namelist go in alongside their group
+    nml = Namelist.from_string(text)
+    nml.update(replacements_dict)
+
+    return nml.to_string()
+
+class Namelist(object):
+    """
+    A CABLE namelist file (formatted key = value) held in memory.
+
+    The base file is parsed once per process (see Namelist.load). Changes
+    are held as overrides on top of the parsed file, so copies are cheap and
+    never touch the base, and the whole file is written out in one go.
+
+    Keys are indexed in a dict, so setting a key costs the same whatever the
+    size of the namelist. Keys that aren't in the file are added after the
+    last key of their group (filename%, casafile%, cable_user%, ...), or
+    before the end of the last namelist group if they don't belong to one.
+    """
+
+    # (path, mtime) -> parsed (lines, index), shared by every copy
+    _parsed = {}
+
+    def __init__(self, lines, index, overrides=None):
+
+        # lines are either (None, row) for text we leave alone or
+        # (key, (key_str, value)) for a key = value statement
+        self.lines = lines
+        self.index = index
+        if overrides is None:
+            overrides = {}
+        self.overrides = overrides
+
+    @classmethod
+    def load(cls, fname):
+        """
+        Namelist for fname, only reading and parsing it the first time
+        """
+        key = (os.path.abspath(fname), os.path.getmtime(fname))
+        if key not in cls._parsed:
+            f = open(fname, 'r')
+            text = f.read()
+            f.close()
+            cls._parsed[key] = cls.parse(text)
+
+        (lines, index) = cls._parsed[key]
+
+        return cls(lines, index)
+
+    @classmethod
+    def from_string(cls, text):
+        (lines, index) = cls.parse(text)
+        return cls(lines, index)
+
+    @staticmethod
+    def parse(text):
+
+        lines = []
+        index = {}       # key -> position in lines
+        for row in text.splitlines():
+            if not row.strip() or "=" not in row or row.startswith("&"):
+                lines.append((None, row))
+            else:
+                (key, val) = row.split("=", 1)
+                index[key.strip()] = len(lines)
+                lines.append((key.strip(), (key.rstrip(), val.lstrip())))
+
+        return (lines, index)
+
+    def copy(self):
+        """
+        Copy sharing the parsed base, only the overrides are duplicated
+        """
+        return Namelist(self.lines, self.index, dict(self.overrides))
+
+    def update(self, replacements):
+        """
+        Set the values of keys (added to the namelist if missing)
+        """
+        self.overrides.update(replacements)
+
+    def get(self, key):
+        if key in self.overrides:
+            return self.overrides[key]
+        elif key in self.index:
+            return self.lines[self.index[key]][1][1]
+        return None
+
+    def to_string(self):
+
+        out = []
+        for (key, row) in self.lines:
+            if key is None:
+                out.append(row)
+            else:
+                (key_str, val) = row
+                out.append(" ".join((key_str, "=",
+                                     self.overrides.get(key, val))))
+
+        # Keys that weren't in the namelist go after the last key in their
+        # group, or failing that before the end of the last namelist group
+        missing = [key for key in self.overrides if key not in self.index]
+        if missing:
+            out = self.insert_missing(out, missing)
+
+        return '\n'.join(out) + '\n'
+
+    def insert_missing(self, out, missing):
+
+        last_in_group = {}
+        end_pos = len(out)
+        for i, (key, row) in enumerate(self.lines):
+            if key is None:
+                if row.strip().lower().startswith("&end") or \
+                   row.strip() == "/":
+                    end_pos = i
+            elif "%" in key:
+                last_in_group[self.get_group(key)] = i
+
+        to_insert = {}  # position -> lines to go in before it
+        for key in missing:
+            group = self.get_group(key)
+            if group is not None and group in last_in_group:
+                pos = last_in_group[group] + 1
+            else:
+                pos = end_pos
+
+            key_to_add = " ".join((key.rstrip(), "=",
+                                   self.overrides[key].strip()))
             # add 3 extra spaces at the front to line things up
             string_length = len(key_to_add) + 3
-            key_to_add = key_to_add.rjust(string_length)
-            lines[i] = key_to_add
-            fix_end_statement = True
+            to_insert.setdefault(pos, []).append(key_to_add.rjust(string_length))
 
-            # Need to add an extra element and sort out counter
-            lines.append("")
-            i += 1
+        new_out = []
+        for i, row in enumerate(out):
+            new_out.extend(to_insert.get(i, []))
+            new_out.append(row)
+        new_out.extend(to_insert.get(len(out), []))
 
-    if fix_end_statement:
-        lines[i] = "&end"
+        return new_out
+
+    def get_group(self, key):
+        """
+        e.g. "cable_user%" for cable_user%GS_SWITCH, None if not grouped
+        """
+        if "%" not in key:
+            return None
+        return key.split("%")[0].strip().lower() + "%"
 
-    return '\n'.join(lines) + '\n'
+    def write(self, fname):
+        """
+        Write the namelist with a single write, renamed into place so CABLE
+        never sees a partial file
+        """
+        tmp_fname = "%s.%d.tmp" % (fname, os.getpid())
+        f = open(tmp_fname, 'w')
+        f.write(self.to_string())
+        f.close()
+        os.replace(tmp_fname, fname)
 
-def get_svn_info(here, there, mcmc_tag=None):
+def move_file(src, dst):
     """
-    Add SVN info and cable namelist file to the output file
+    Move src to dst such that dst only ever appears complete: a rename if
+    they are on the same filesystem, otherwise copied next to dst and then
+    renamed into place (e.g. from node-local scratch to the output dir).
     """
-
-    #print(there)
-    os.chdir(there)
-    #print(os.system("svn info"))
-    #print(os.getcwd())
-    if mcmc_tag is not None:
-        os.system("svn info > tmp_svn_%s" % (mcmc_tag))
-        fname = 'tmp_svn_%s' % (mcmc_tag)
+    try:
+        os.replace(src, dst)
+    except OSError:
+        tmp_fname = "%s.%d.tmp" % (dst, os.getpid())
+        shutil.copy2(src, tmp_fname)
+        os.replace(tmp_fname, dst)
+        os.remove(src)
+
+# Where the svn info for each source tree is kept between runs, in the
+# user's own cache dir as /tmp is shared with everyone else on the node
+SVN_INFO_CACHE = os.path.join(os.environ.get("XDG_CACHE_HOME",
+                                             os.path.expanduser("~/.cache")),
+                              "cable", "svn_info.json")
+
+# (source path, mtime) -> (url, rev), for this process
+_svn_info = {}
+
+def get_svn_info(here, there, mcmc_tag=None, cache_fname=SVN_INFO_CACHE):
+    """
+    Get the SVN url and revision of the CABLE source in "there", to add to
+    the output file.
+
+    svn is only run the first time we see a source tree (or once it has been
+    updated), after that the answer comes from the in-memory cache, or the
+    one on disk shared between processes/runs. We no longer change dir or
+    write temp files, so "here" and "mcmc_tag" aren't needed, they're kept
+    so old calls still work.
+    """
+    there = os.path.abspath(there)
+    key = "%s:%s" % (there, get_svn_mtime(there))
+    if key in _svn_info:
+        return _svn_info[key]
+
+    cache = read_svn_info_cache(cache_fname)
+    if key in cache:
+        (url, rev) = cache[key]
     else:
-        os.system("svn info > tmp_svn")
-        fname = 'tmp_svn'
+        try:
+            svn = subprocess.run(["svn", "info"], cwd=there,
+                                 stdout=subprocess.PIPE,
+                                 stderr=subprocess.DEVNULL,
+                                 universal_newlines=True).stdout.splitlines()
+        except OSError:
+            # no svn
+            svn = []
+
+        url = [i.split(":", 1)[1].strip() \
+                for i in svn if i.startswith('URL')]
+        rev = [i.split(":", 1)[1].strip() \
+                for i in svn if i.startswith('Revision')]
+
+        # Don't remember a failed lookup, svn may work next time
+        if cache_fname is not None and len(url) > 0 and len(rev) > 0:
+            try:
+                write_svn_info_cache(cache_fname, key, url, rev)
+            except OSError as e:
+                print("Couldn't save the svn info to %s: %s" % \
+                        (cache_fname, e))
+
+    _svn_info[key] = (url, rev)
 
-    fp = open(fname, "r")
-    svn = fp.readlines()
-    fp.close()
-    os.remove(fname)
+    return url, rev
 
-    url = [i.split(":", 1)[1].strip() \
-            for i in svn if i.startswith('URL')]
-    rev = [i.split(":", 1)[1].strip() \
-            for i in svn if i.startswith('Revision')]
-    os.chdir(here)
+def read_svn_info_cache(cache_fname):
 
-    return url, rev
+    if cache_fname is None or not os.path.isfile(cache_fname):
+        return {}
+    try:
+        with open(cache_fname, "r") as f:
+            cache = json.load(f)
+    except (OSError, ValueError):
+        cache = {}
+
+    return cache
+
+def write_svn_info_cache(cache_fname, key, url, rev):
+    """
+    Add a source tree to the svn info cache. Several runs may be doing this
+    at once, so it's locked and re-read first.
+    """
+    os.makedirs(os.path.dirname(cache_fname), exist_ok=True)
+    with open("%s.lock" % (cache_fname), "a") as lock:
+        fcntl.flock(lock.fileno(), fcntl.LOCK_EX)
+        cache = read_svn_info_cache(cache_fname)
+        cache[key] = (url, rev)
+        tmp_fname = "%s.%d.tmp" % (cache_fname, os.getpid())
+        with open(tmp_fname, "w") as f:
+            json.dump(cache, f, indent=2)
+        os.replace(tmp_fname, cache_fname)
+
+def get_svn_mtime(there):
+    """
+    When the working copy "there" belongs to was last changed (an svn update
+    rewrites .svn/wc.db at the root of the working copy)
+    """
+    path = there
+    while True:
+        wc_db = os.path.join(path, ".svn", "wc.db")
+        if os.path.isfile(wc_db):
+            return os.path.getmtime(wc_db)
+        parent = os.path.dirname(path)
+        if parent == path:
+            break
+        path = parent
+
+    return os.path.getmtime(there)
 
 
 def add_attributes_to_output_file(nml_fname, fname, url, rev):
@@ -193,6 +400,8 @@ def change_LAI(met_fname, site, fixed=None, lai_dir=None):
         df_lai = pd.read_csv(lai_fname)
 
         if lai_dir is not None:
+            import xarray as xr # only needed here, slow to import
+
             ds = xr.open_dataset(met_fname)
 
             vars_to_keep = ['Tair']
@@ -282,6 +491,8 @@ def get_years(met_fname, nyear_spinup):
     need to recycle the met data to cover the transient period and the
     start and end of the transient period.
     """
+    import xarray as xr # only needed here, slow to import
+
     pre_indust = 1850
 
     ds = xr.open_dataset(met_fname)
@@ -310,19 +521,103 @@ def get_years(met_fname, nyear_spinup):
     return (st_yr, en_yr, st_yr_transient, en_yr_transient,
             st_yr_spin, en_yr_spin)
 
+class PoolSummaryCache(object):
+    """
+    The pool sizes (plant, soil and passive C) held in CASA restart files and
+    the mean NPP from CABLE output files, kept in memory so each file is only
+    read once however many spin checks it is used in. Only the variables we
+    need are read, with netCDF4.
+
+    Some runs overwrite an earlier restart (the analytical spin and the
+    historical run), so entries are keyed on the file's size and
+    modification time as well as its name.
+    """
+
+    def __init__(self):
+        self.summaries = {}
+
+    def get_pools(self, fname):
+        return self.get(fname, self.read_pools)
+
+    def get_npp(self, fname):
+        return self.get(fname, self.read_npp)
+
+    def get(self, fname, reader):
+
+        stat = os.stat(fname)
+        key = (os.path.abspath(fname), stat.st_mtime_ns, stat.st_size,
+               reader.__name__)
+        if key not in self.summaries:
+            self.summaries[key] = reader(fname)
+
+        return self.summaries[key]
+
+    def read_pools(self, fname):
+
+        ds = netCDF4.Dataset(fname)
+        cplant = np.ma.filled(ds.variables["cplant"][:], np.nan)
+        csoil = np.ma.filled(ds.variables["csoil"][:], np.nan)
+        ds.close()
+
+        pools = {
+            "cplant": np.sum(cplant),
+            "cl": cplant[0][0],
+            "cw": cplant[1][0],
+            "cr": cplant[2][0],
+            "csoil": np.sum(csoil),
+            "active": csoil[0][0],
+            "slow": csoil[1][0],
+            "passive": csoil[2][0],
+        }
+
+        return pools
+
+    def read_npp(self, fname):
+
+        ds = netCDF4.Dataset(fname)
+        npp = np.ma.filled(ds.variables["NPP"][:], np.nan)
+        ds.close()
+
+        return np.mean(npp)
+
+# Shared by every check_steady_state call in this process, unless given one
+_pool_cache = PoolSummaryCache()
+
+def get_casa_pools(fname, cache=None):
+    """
+    Pool sizes in a CASA restart file, see PoolSummaryCache
+    """
+    if cache is None:
+        cache = _pool_cache
+
+    return cache.get_pools(fname)
+
 def check_steady_state(experiment_id, restart_dir, output_dir, num,
                        check_npp=False, check_plant=False, check_soil=False,
-                       check_passive=False, debug=False):
+                       check_passive=False, debug=False, cache=None,
+                       tol=None, return_delta=False):
     """
     Check whether the plant (leaves, wood and roots) carbon pools have reached
     equilibrium. To do this we are checking the state of the last year in the
     previous spin cycle to the state in the final year of the current spin
     cycle.
+
+    The pools are read through a PoolSummaryCache, so the previous cycle's
+    files, already read for the last check, aren't read again.
+
+    tol replaces the default tolerance for whichever check is made, and with
+    return_delta=True we get (not_in_equilibrium, delta, tol) back, so the
+    caller can see how far off steady state we still are.
     """
     tol_npp = 0.005 # delta < 10^-4 g C m-2, Xia et al. 2013
     tol_plant = 0.1 # delta steady-state carbon (%), Xia et al. 2013
     tol_soil = 0.01
     tol_pass = 0.5   # delta passive pool (g C m-2 yr-1), Xia et al. 2013
+    if tol is not None:
+        tol_npp = tol_plant = tol_soil = tol
+
+    if cache is None:
+        cache = _pool_cache
 
     if num == 1:
         prev_npp = 99999.9
@@ -335,42 +630,38 @@ def check_steady_state(experiment_id, restart_dir, output_dir, num,
     else:
         casa_rst_ofname = "%s_casa_rst_%d.nc" % (experiment_id, num-1)
         fname = os.path.join(restart_dir, casa_rst_ofname)
-        ds_casa = xr.open_dataset(fname)
-        prev_cplant = np.sum(ds_casa.cplant.values)
-        prev_cl = ds_casa.cplant.values[0][0]
-        prev_cw = ds_casa.cplant.values[1][0]
-        prev_cr = ds_casa.cplant.values[2][0]
-        prev_csoil = np.sum(ds_casa.csoil.values)
-        prev_passive = ds_casa.csoil.values[2][0]
-        ds_casa.close()
+        pools = cache.get_pools(fname)
+        prev_cplant = pools["cplant"]
+        prev_cl = pools["cl"]
+        prev_cw = pools["cw"]
+        prev_cr = pools["cr"]
+        prev_csoil = pools["csoil"]
+        prev_passive = pools["passive"]
 
         if check_npp:
             cable_ofname = "%s_out_cable_spin_%d.nc" % (experiment_id, num-1)
             fname = os.path.join(output_dir, cable_ofname)
-            ds_cable = xr.open_dataset(fname, decode_times=False)
-            prev_npp = np.mean(ds_cable.NPP.values)
-            ds_cable.close()
+            prev_npp = cache.get_npp(fname)
 
     casa_rst_ofname = "%s_casa_rst_%d.nc" % (experiment_id, num)
     fname = os.path.join(restart_dir, casa_rst_ofname)
-    ds_casa = xr.open_dataset(fname)
-    new_cplant = np.sum(ds_casa.cplant.values)
-    new_cl = ds_casa.cplant.values[0][0]
-    new_cw = ds_casa.cplant.values[1][0]
-    new_cr = ds_casa.cplant.values[2][0]
-    new_csoil = np.sum(ds_casa.csoil.values)
-    new_passive = ds_casa.csoil.values[2][0]
-    ds_casa.close()
+    pools = cache.get_pools(fname)
+    new_cplant = pools["cplant"]
+    new_cl = pools["cl"]
+    new_cw = pools["cw"]
+    new_cr = pools["cr"]
+    new_csoil = pools["csoil"]
+    new_passive = pools["passive"]
 
     if check_npp:
         cable_ofname = "%s_out_cable_spin_%d.nc" % (experiment_id, num)
         fname = os.path.join(output_dir, cable_ofname)
-        ds_cable = xr.open_dataset(fname, decode_times=False)
-        new_npp = np.mean(ds_cable.NPP.values)
-        ds_cable.close()
+        new_npp = cache.get_npp(fname)
 
     if check_npp:
-        if ( np.fabs(new_npp - prev_npp) < tol_npp ):
+        delta = np.fabs(new_npp - prev_npp)
+        tol = tol_npp
+        if ( delta < tol_npp ):
              not_in_equilibrium = False
         else:
             not_in_equilibrium = True
@@ -387,6 +678,8 @@ def check_steady_state(experiment_id, restart_dir, output_dir, num,
             delta_cl = np.fabs(new_cl - prev_cl) / new_cl
             delta_cw = np.fabs(new_cw - prev_cw) / new_cw
             delta_cr = np.fabs(new_cr - prev_cr) / new_cr
+            delta = delta_cl + delta_cw + delta_cr
+            tol = tol_plant
             if ( delta_cl + delta_cw + delta_cr  < tol_plant ):
             #if ( np.fabs((new_cplant - prev_cplant) / new_cplant) < tol_plant ):
                  not_in_equilibrium = False
@@ -400,7 +693,9 @@ def check_steady_state(experiment_id, restart_dir, output_dir, num,
                       delta_cl + delta_cw + delta_cr, tol_plant  )
                 print("\n===============================================\n")
         elif check_soil:
-            if ( np.fabs((new_csoil - prev_csoil) / new_csoil) < tol_soil ):
+            delta = np.fabs((new_csoil - prev_csoil) / new_csoil)
+            tol = tol_soil
+            if ( delta < tol_soil ):
                  not_in_equilibrium = False
             else:
                 not_in_equilibrium = True
@@ -443,8 +738,88 @@ def check_steady_state(experiment_id, restart_dir, output_dir, num,
                       np.fabs((new_csoil - prev_csoil) / new_csoil))
                 print("\n===============================================\n")
         """
+    if return_delta:
+        return (not_in_equilibrium, float(delta), tol)
     return not_in_equilibrium
 
+def extrapolate_casa_restart(experiment_id, restart_dir, num, max_ratio=0.95,
+                             debug=False):
+    """
+    Jump the CASA pools towards steady state by fitting the trajectory of
+    each pool over the last three restarts (num-2, num-1, num) as an
+    exponential approach, i.e. Aitken extrapolation:
+
+        x_inf = x2 + (x2 - x1) * r / (1 - r), r = (x2 - x1) / (x1 - x0)
+
+    Only pools heading steadily towards equilibrium (0 < r < max_ratio) are
+    moved, which also caps the jump at r / (1 - r) times the last change.
+    The N and P pools are scaled by the same factor as the matching C pool,
+    so the stoichiometry is kept. Restart num is overwritten with the result
+    and the original is kept as *_casa_rst_<num>_unextrapolated.nc,
+    replacing any earlier backup for num, i.e. from before the spin was
+    re-run.
+
+    Returns True if any pool was extrapolated.
+    """
+    fnames = [os.path.join(restart_dir,
+                           "%s_casa_rst_%d.nc" % (experiment_id, n)) \
+                for n in [num-2, num-1, num]]
+    if not all([os.path.isfile(f) for f in fnames]):
+        return False
+
+    c_pools = ["cplant", "clitter", "csoil"]
+    pools = {}
+    for v in c_pools:
+        pools[v] = []
+        for fname in fnames:
+            ds = netCDF4.Dataset(fname)
+            if v in ds.variables:
+                pools[v].append(np.ma.filled(ds.variables[v][:].astype(np.float64),
+                                             np.nan))
+            ds.close()
+
+    scales = {}
+    extrapolated = False
+    for v in c_pools:
+        if len(pools[v]) != 3:
+            continue
+        (x0, x1, x2) = pools[v]
+        d1 = x1 - x0
+        d2 = x2 - x1
+        with np.errstate(divide="ignore", invalid="ignore"):
+            r = d2 / d1
+            ok = np.isfinite(r) & (d1 != 0.0) & (r > 0.0) & (r < max_ratio)
+            x_inf = np.where(ok, x2 + d2 * r / (1.0 - r), x2)
+            x_inf = np.maximum(x_inf, 0.0)
+            scales[v] = np.where(ok & (x2 > 0.0), x_inf / x2, 1.0)
+        if np.any(ok):
+            extrapolated = True
+
+        if debug:
+            print("%s: %f -> %f" % (v, np.nansum(x2), np.nansum(x_inf)))
+
+    if not extrapolated:
+        return False
+
+    fname = fnames[-1]
+    backup_fname = "%s_unextrapolated.nc" % (os.path.splitext(fname)[0])
+    shutil.copy(fname, backup_fname)
+
+    tmp_fname = "%s.%d.tmp" % (fname, os.getpid())
+    shutil.copy(fname, tmp_fname)
+    ds = netCDF4.Dataset(tmp_fname, "r+")
+    for v in c_pools:
+        if v not in scales:
+            continue
+        # nplant, pplant, nsoil, ...
+        for w in [v, "n" + v[1:], "p" + v[1:]]:
+            if w in ds.variables:
+                ds.variables[w][:] = ds.variables[w][:] * scales[v]
+    ds.close()
+    os.replace(tmp_fname, fname)
+
+    return True
+
 def generate_spatial_qsub_script(qsub_fname, walltime, mem, ncpus,
                                  spin_up=False, CNP=False):
 
@@ -17,9 +17,16 @@ __author__ = "Martin De Kauwe"
 __version__ = "1.0 (12.11.2017)"
 __email__ = "mdekauwe@gmail.com"
 
+# Part of the met cache key, see met_cache.py. It MUST be bumped whenever a
+# change here can change the files we write, otherwise the cache will keep
+# handing out files made by the old code.
+GENERATOR_VERSION = 2
+
 import os
 import sys
 import glob
+import json
+import shutil
 import netCDF4 as nc
 import datetime as dt
 import numpy as np
@@ -29,11 +36,25 @@ import calendar
 
 class GenerateMetFiles(object):
 
-    def __init__(self, site,  met_fname, co2_ndep_fname):
+    def __init__(self, site,  met_fname, co2_ndep_fname, chunk_size=175200,
+                 cache_dir=None, zlib=False, complevel=4, shuffle=True,
+                 time_chunk=None):
 
         self.site = site
         self.met_fname = met_fname
         self.co2_ndep_fname = co2_ndep_fname
+        # Where the year mapping tables are saved (e.g. the met dir)
+        self.cache_dir = cache_dir
+        # Number of timesteps (rows) written at once to the transient file,
+        # ~10 yrs of half-hourly data. None writes each variable in one go.
+        self.chunk_size = chunk_size
+        # netCDF4 compression & chunking of the output variables. time_chunk
+        # is the number of timesteps per (time-contiguous) netCDF chunk, None
+        # leaves it to the netCDF library.
+        self.zlib = zlib
+        self.complevel = complevel
+        self.shuffle = shuffle
+        self.time_chunk = time_chunk
         self.KG_2_G = 1000.0
         self.HA_2_M2 = 10000.0
         self.YR_2_DAY = 365.0
@@ -46,77 +67,8 @@ class GenerateMetFiles(object):
         Todo:
         - Add flag to not add Ndep / Pdep?
         """
-
-        ds = nc.Dataset(self.met_fname)
-        out = nc.Dataset(ofname, 'w', format='NETCDF4')
-
-        nc_attrs = ds.ncattrs()
-        nc_dims = [dim for dim in ds.dimensions]
-        #nc_vars = [var for var in ds.variables]
-        nc_vars = ds.variables.keys()
-
-        # Write vars
-        for v in nc_vars:
-            if len(ds.variables[v].dimensions) == 1:
-                out.createDimension(v, ds.variables[v].size)
-                out.createVariable(v, ds.variables[v].dtype, (v,))
-                ncvar = ds.variables[v]
-                if hasattr(ncvar, 'units'):
-                    mval = ncvar.units
-                    out.variables[v].setncatts({'units': mval})
-                out.variables[v][:] = ds.variables[v][:]
-            else:
-                out.createVariable(v, ds.variables[v].dtype,
-                                   ds.variables[v].dimensions)
-                if len(ds.variables[v].dimensions) == 2:
-                    out.variables[v][:,:] = ds.variables[v][:,:]
-                elif len(ds.variables[v].dimensions) == 3:
-                    out.variables[v][:,:,:] = ds.variables[v][:,:,:]
-                elif len(ds.variables[v].dimensions) == 4:
-                    out.variables[v][:,:,:,:] = ds.variables[v][:,:,:,:]
-                ncvar = ds.variables[v]
-                out = self.write_attributes(v, ncvar, out)
-
-        # Add CO2, NDEP & PDEP
-        try:
-            out_length = len(ds.variables["Rainf"][:,:])
-        except:
-            out_length = len(ds.variables["Precip"][:,:])
-
-        #ndim = 1
-        #out.createDimension('z', ndim)
-
-        for v in ["CO2air", "Ndep", "Pdep"]:
-            out.createVariable(v, 'float32', ('time', 'y', 'x'))
-
-        out.variables["CO2air"][:,:,:] = np.ones((out_length,1,1)) * \
-                                                   co2_fixed
-        out.variables["CO2air"].setncatts({'units': "ppm"})
-        out.variables["CO2air"].setncatts({'missing_value': "-9999"})
-        out.variables["CO2air"].setncatts({'long_name':
-                                           "Atmosphereic CO2 concentration"})
-
-        # kg ha-1 y-1 -> gN m-2 d-1
-        conv = self.KG_2_G / self.HA_2_M2 / self.YR_2_DAY
-        out.variables["Ndep"][:,:,:] = np.ones((out_length,1,1)) * \
-                                                 (ndep_fixed * conv)
-        out.variables["Ndep"].setncatts({'units': "gN/m^2/d^1"})
-        out.variables["Ndep"].setncatts({'missing_value': "-9999"})
-        out.variables["Ndep"].setncatts({'long_name': "N deposition"})
-
-        out.variables["Pdep"][:,:,:] = np.ones((out_length,1,1)) *  \
-                                                 (pdep_fixed * conv)
-        out.variables["Pdep"].setncatts({'units': "gP/m^2/d^1"})
-        out.variables["Pdep"].setncatts({'missing_value': "-9999"})
-        out.variables["Pdep"].setncatts({'long_name': "P deposition"})
-
-        # write global attributes
-        for ncattr in ds.ncattrs():
-            if ncattr != "_NCProperties":
-                out.setncattr(ncattr, getattr(ds, ncattr))
-
-        ds.close()
-        out.close()
+        self.create_all(fname_spin=ofname, co2_fixed=co2_fixed,
+                        ndep_fixed=ndep_fixed, pdep_fixed=pdep_fixed)
 
     def create_transient_file(self, ofname):
         """
@@ -127,13 +79,77 @@ class GenerateMetFiles(object):
         Todo:
         - Add flag to not add Ndep / Pdep?
         """
+        self.create_all(fname_trans=ofname)
+
+    def create_simulation_file(self, ofname):
+        """
+        Read in the met file and dump it back out unmodified except for the
+        addition of time varying CO2, Ndep & Pdep.
+        """
+        self.create_all(fname_sim=ofname)
 
+    def create_transient_descriptor(self, ofname):
+        """
+        Rather than a physical copy of the met record tiled back to 1850,
+        write a small (json) description of the transient file: the source
+        met file, the year mapping and the annual CO2, Ndep & Pdep. Use
+        TransientMet to read time slices from it, or to materialise the
+        full transient file when it is actually needed.
+        """
         ds = nc.Dataset(self.met_fname)
-        out = nc.Dataset(ofname, 'w', format='NETCDF4')
+        time = nc.num2date(ds.variables['time'][[0, -1]],
+                           ds.variables['time'].units)
+        ds.close()
 
-        #offset = ds.variables['time'][1] - ds.variables['time'][0]
-        #time = nc.num2date(ds.variables['time'][:] -offset,
-        #                   ds.variables['time'].units)
+        start_yr = time[0].year
+        end_yr = time[-1].year
+
+        year_map = get_year_mapping(start_yr, end_yr, cache_dir=self.cache_dir)
+        forcing = get_forcing_table(self.co2_ndep_fname)
+        (cx, nx, px) = forcing.lookup(year_map[:,0])
+
+        descriptor = {
+            "site": self.site,
+            "met_fname": os.path.abspath(self.met_fname),
+            "co2_ndep_fname": os.path.abspath(self.co2_ndep_fname),
+            "year_map": year_map.tolist(),
+            "CO2air": cx.tolist(),
+            "Ndep": nx.tolist(),
+            "Pdep": px.tolist(),
+        }
+        with open(ofname, "w") as f:
+            json.dump(descriptor, f)
+
+    def create_all(self, fname_spin=None, fname_trans=None, fname_sim=None,
+                   co2_fixed=None, ndep_fixed=None, pdep_fixed=None,
+                   year_map=None, annual_forcing=None):
+        """
+        Generate the spin, transient and simulation files in a single pass:
+        the met file is opened once, each variable is read once and written
+        to every requested output, and the CO2/Ndep/Pdep forcing is only
+        read once. Any of the three files can be skipped by passing None.
+
+        The transient year mapping and annual (CO2, Ndep, Pdep) can be passed
+        in, e.g. from a transient descriptor, otherwise they are built from
+        the met file and co2_ndep_fname.
+
+        The spin and simulation files only differ in their CO2, Ndep & Pdep,
+        so when we want both the simulation file is a straight copy of the
+        spin file with the forcing overwritten.
+        """
+        ds = nc.Dataset(self.met_fname)
+
+        spin = None
+        trans = None
+        sim = None
+        if fname_spin is not None:
+            spin = nc.Dataset(fname_spin, 'w', format='NETCDF4')
+        if fname_trans is not None:
+            trans = nc.Dataset(fname_trans, 'w', format='NETCDF4')
+        copy_sim = fname_spin is not None and fname_sim is not None
+        if fname_sim is not None and not copy_sim:
+            sim = nc.Dataset(fname_sim, 'w', format='NETCDF4')
+        copies = [out for out in [spin, sim] if out is not None]
 
         time = nc.num2date(ds.variables['time'][:],
                            ds.variables['time'].units)
@@ -142,241 +158,219 @@ class GenerateMetFiles(object):
         start_yr = time[0].year
         end_yr = time[-1].year
 
-        (actual_yrs, yr_seq) = self.get_leap_sequence_of_years(start_yr, end_yr)
-
-        # Figure out the number of timesteps in the new file
+        # Figure out where each year sits in the original met file
         orig_years = np.asarray([i.year for i in time])
+        year_slices = self.get_year_slice_table(orig_years)
 
-        n = 0
-        for yr in yr_seq:
-            idx = np.argwhere(orig_years==yr)
-            n += len(idx)
+        if trans is not None:
+            if year_map is None:
+                (actual_yrs,
+                 yr_seq) = self.get_leap_sequence_of_years(start_yr, end_yr)
+            else:
+                (actual_yrs, yr_seq) = (year_map[:,0], year_map[:,1])
+                pre_industrial = int(actual_yrs[0])
+
+            # Number of timesteps each recycled year contributes
+            nsteps = [year_slices[yr][1] - year_slices[yr][0] \
+                        for yr in yr_seq]
+            n = int(np.sum(nsteps))
 
-        nc_attrs = ds.ncattrs()
-        nc_dims = [dim for dim in ds.dimensions]
-        #nc_vars = [var for var in ds.variables]
         nc_vars = ds.variables.keys()
 
-        # Write vars
+        # Write vars, reading each one from the met file just the once
         for v in nc_vars:
-            if len(ds.variables[v].dimensions) == 1:
-                if v == "time":
-                    out.createDimension(v, n)
-                else:
-                    out.createDimension(v, ds.variables[v].size)
-                out.createVariable(v, ds.variables[v].dtype, (v,))
-                ncvar = ds.variables[v]
-                if hasattr(ncvar, 'units'):
-                    mval = "seconds since %s-01-01 00:00:00" % (pre_industrial)
-                    if v == "time":
-                        out.variables[v].setncatts({'units': mval})
-                    else:
-                        mval = ncvar.units
-                        out.variables[v].setncatts({'units': mval})
-
-                if v == "time":
-                    jump = ds.variables[v][1]-ds.variables[v][0]
-                    tx = []
-                    val = 0.0
-                    for i in range(n):
-                        tx.append(val)
-                        val += jump
-                    out.variables[v][:] = np.asarray(tx)
-                else:
-                    out.variables[v][:] = ds.variables[v][:]
-
-            else:
-                out.createVariable(v, ds.variables[v].dtype,
-                                   ds.variables[v].dimensions)
-                if len(ds.variables[v].dimensions) == 2:
-                    out.variables[v][:,:] = ds.variables[v][:,:]
-                elif len(ds.variables[v].dimensions) == 3:
-                    tx = np.zeros((n,1,1))
-                    cnt1 = 0
-                    cnt2 = 0
-                    for yr in yr_seq:
-                        idx = np.argwhere(orig_years==yr)
-                        st = idx[0][0]
-                        en = idx[-1][0] + 1
-                        slice = ds.variables[v][st:en,:,:]
-                        cnt2 += len(slice)
-                        tx[cnt1:cnt2,:,:] = ds.variables[v][st:en,:,:]
-                        cnt1 += len(slice)
-                    out.variables[v][:,:,:] = tx
-                elif len(ds.variables[v].dimensions) == 4:
-                    tx = np.zeros((n,1,1,1))
-                    cnt1 = 0
-                    cnt2 = 0
-                    for yr in yr_seq:
-                        idx = np.argwhere(orig_years==yr)
-                        st = idx[0][0]
-                        en = idx[-1][0] + 1
-                        slice = ds.variables[v][st:en,:,:,:]
-                        cnt2 += len(slice)
-                        tx[cnt1:cnt2,:,:,:] = ds.variables[v][st:en,:,:,:]
-                        cnt1 += len(slice)
-                    out.variables[v][:,:,:,:] = tx
-                ncvar = ds.variables[v]
-                out = self.write_attributes(v, ncvar, out)
+            ncvar = ds.variables[v]
+            data = ncvar[:]
 
+            for out in copies:
+                self.write_variable(v, ncvar, data, out)
 
-        #ndim = 1
-        #out.createDimension('z', ndim)
-
-        for v in ["CO2air", "Ndep", "Pdep"]:
-            out.createVariable(v, 'float32', ('time', 'y', 'x'))
+            if trans is not None:
+                self.write_transient_variable(v, ncvar, data, trans, n,
+                                              yr_seq, year_slices,
+                                              pre_industrial)
 
         # Add CO2, NDEP & PDEP
-        df = pd.read_csv(self.co2_ndep_fname, sep=';')
-
-        cnt1 = 0
-        cnt2 = 0
-        cx = np.zeros((n,1,1))
-        nx = np.zeros((n,1,1))
-        px = np.zeros((n,1,1))
-        y = pre_industrial
-        for yr in yr_seq:
-            idx = np.argwhere(orig_years==yr)
-            st = idx[0][0]
-            en = idx[-1][0] + 1
-            slice = ds.variables["SWdown"][st:en,:,:]
-            cnt2 += len(slice)
-            cx[cnt1:cnt2,:] = df[df.Year == y]["CO2 [ppm]"].values[0]
-            nx[cnt1:cnt2,:] = df[df.Year == y]["ndepo [kgN/ha/yr]"].values[0]
-            px[cnt1:cnt2,:] = df[df.Year == y]["pdepo [kgP/ha/yr]"].values[0]
-            cnt1 += len(slice)
-            y += 1
-
-        
-        out.variables["CO2air"][:,:,:] = cx
-        out.variables["CO2air"].setncatts({'units': "ppm"})
-        out.variables["CO2air"].setncatts({'missing_value': "-9999"})
-        out.variables["CO2air"].setncatts({'long_name':
-                                           "Atmosphereic CO2 concentration"})
+        if fname_sim is not None or \
+            (trans is not None and annual_forcing is None):
+            forcing = get_forcing_table(self.co2_ndep_fname)
 
         # kg ha-1 y-1 -> gN m-2 d-1
         conv = self.KG_2_G / self.HA_2_M2 / self.YR_2_DAY
-        out.variables["Ndep"][:,:,:] = nx * conv
-        out.variables["Ndep"].setncatts({'units': "gN/m^2/d^1"})
-        out.variables["Ndep"].setncatts({'missing_value': "-9999"})
-        out.variables["Ndep"].setncatts({'long_name': "N deposition"})
 
-        out.variables["Pdep"][:,:,:] = px * conv
-        out.variables["Pdep"].setncatts({'units': "gP/m^2/d^1"})
-        out.variables["Pdep"].setncatts({'missing_value': "-9999"})
-        out.variables["Pdep"].setncatts({'long_name': "P deposition"})
+        if spin is not None:
+            self.create_forcing_variables(spin)
 
-        # write global attributes
-        for ncattr in ds.ncattrs():
-            if ncattr != "_NCProperties":
-                out.setncattr(ncattr, getattr(ds, ncattr))
+            self.write_constant(spin.variables["CO2air"], co2_fixed)
+            self.write_constant(spin.variables["Ndep"], ndep_fixed * conv)
+            self.write_constant(spin.variables["Pdep"], pdep_fixed * conv)
 
-        ds.close()
-        out.close()
+            self.write_forcing_attributes(spin)
 
-    def create_simulation_file(self, ofname):
+        if trans is not None:
+            if annual_forcing is None:
+                (cx, nx, px) = forcing.lookup(pre_industrial + \
+                                              np.arange(len(yr_seq)))
+            else:
+                (cx, nx, px) = annual_forcing
+            self.create_forcing_variables(trans)
 
-        ds = nc.Dataset(self.met_fname)
-        out = nc.Dataset(ofname, 'w', format='NETCDF4')
+            for (st, en, idx, yr_pos) in \
+                self.iter_gather_chunks(yr_seq, year_slices):
+                trans.variables["CO2air"][st:en,:,:] = \
+                    cx[yr_pos].reshape(-1,1,1)
+                trans.variables["Ndep"][st:en,:,:] = nx[yr_pos].reshape(-1,1,1)
+                trans.variables["Pdep"][st:en,:,:] = px[yr_pos].reshape(-1,1,1)
 
-        time = nc.num2date(ds.variables['time'][:],
-                           ds.variables['time'].units)
+            self.write_forcing_attributes(trans)
 
-        start_yr = time[0].year
-        end_yr = time[-1].year
-        num_yrs = start_yr - end_yr
-        yr_sequence = np.arange(start_yr, end_yr+1)
+        if sim is not None:
+            self.create_forcing_variables(sim)
+            self.write_simulation_forcing(sim, forcing, orig_years)
+            self.write_forcing_attributes(sim)
 
-        # Figure out the number of timesteps in the new file
-        years = np.asarray([i.year for i in time])
+        # write global attributes
+        for out in [spin, trans, sim]:
+            if out is None:
+                continue
+            for ncattr in ds.ncattrs():
+                if ncattr != "_NCProperties":
+                    out.setncattr(ncattr, getattr(ds, ncattr))
+            out.close()
 
-        n = 0
-        for yr in yr_sequence:
-            idx = np.argwhere(years==yr)
-            n += len(idx)
+        ds.close()
 
-        nc_attrs = ds.ncattrs()
-        nc_dims = [dim for dim in ds.dimensions]
-        #nc_vars = [var for var in ds.variables]
-        nc_vars = ds.variables.keys()
+        if copy_sim:
+            shutil.copyfile(fname_spin, fname_sim)
+            sim = nc.Dataset(fname_sim, 'r+')
+            self.write_simulation_forcing(sim, forcing, orig_years)
+            sim.close()
 
-        # Write vars
-        for v in nc_vars:
-            if len(ds.variables[v].dimensions) == 1:
-                out.createDimension(v, ds.variables[v].size)
-                out.createVariable(v, ds.variables[v].dtype, (v,))
-                ncvar = ds.variables[v]
-                if hasattr(ncvar, 'units'):
+    def write_simulation_forcing(self, out, forcing, years):
+        """
+        Annual CO2, Ndep & Pdep for each timestep of the met record
+        """
+        start_yr = years[0]
+        end_yr = years[-1]
+        (cx, nx, px) = forcing.lookup(np.arange(start_yr, end_yr + 1))
+
+        yr_pos = years - start_yr
+        out.variables["CO2air"][:,:,:] = cx[yr_pos].reshape(-1,1,1)
+        out.variables["Ndep"][:,:,:] = nx[yr_pos].reshape(-1,1,1)
+        out.variables["Pdep"][:,:,:] = px[yr_pos].reshape(-1,1,1)
+
+    def write_constant(self, ncvar, value):
+        """
+        Fill a (time, ...) variable with a constant, a chunk at a time from a
+        single reused buffer rather than a full length temporary array
+        """
+        n = ncvar.shape[0]
+        chunk_size = n if self.chunk_size is None else min(self.chunk_size, n)
+        buf = np.full((chunk_size,) + ncvar.shape[1:], value,
+                      dtype=ncvar.dtype)
+        for st in range(0, n, chunk_size):
+            en = min(st + chunk_size, n)
+            ncvar[st:en] = buf[:en-st]
+
+    def write_variable(self, v, ncvar, data, out):
+        """
+        Copy a variable from the met file unmodified
+        """
+        if len(ncvar.dimensions) == 1:
+            out.createDimension(v, ncvar.size)
+            self.create_variable(out, v, ncvar.dtype, (v,))
+            if hasattr(ncvar, 'units'):
+                mval = ncvar.units
+                out.variables[v].setncatts({'units': mval})
+            out.variables[v][:] = data
+        else:
+            self.create_variable(out, v, ncvar.dtype, ncvar.dimensions)
+            if len(ncvar.dimensions) in [2, 3, 4]:
+                out.variables[v][:] = data
+            out = self.write_attributes(v, ncvar, out)
+
+    def write_transient_variable(self, v, ncvar, data, out, n, yr_seq,
+                                 year_slices, pre_industrial):
+        """
+        Write a variable from the met file recycled over the transient
+        period. The recycled years are gathered and written a chunk at a
+        time so we never hold the full transient record in memory.
+        """
+        if len(ncvar.dimensions) == 1:
+            if v == "time":
+                out.createDimension(v, n)
+            else:
+                out.createDimension(v, ncvar.size)
+            self.create_variable(out, v, ncvar.dtype, (v,))
+            if hasattr(ncvar, 'units'):
+                mval = "seconds since %s-01-01 00:00:00" % (pre_industrial)
+                if v == "time":
+                    out.variables[v].setncatts({'units': mval})
+                else:
                     mval = ncvar.units
                     out.variables[v].setncatts({'units': mval})
-                out.variables[v][:] = ds.variables[v][:]
+
+            if v == "time":
+                jump = data[1] - data[0]
+                for (st, en, idx, yr_pos) in \
+                    self.iter_gather_chunks(yr_seq, year_slices):
+                    out.variables[v][st:en] = np.arange(st, en) * jump
             else:
-                out.createVariable(v, ds.variables[v].dtype,
-                                   ds.variables[v].dimensions)
-                if len(ds.variables[v].dimensions) == 2:
-                    out.variables[v][:,:] = ds.variables[v][:,:]
-                elif len(ds.variables[v].dimensions) == 3:
-                    out.variables[v][:,:,:] = ds.variables[v][:,:,:]
-                elif len(ds.variables[v].dimensions) == 4:
-                    out.variables[v][:,:,:,:] = ds.variables[v][:,:,:,:]
-                ncvar = ds.variables[v]
-                out = self.write_attributes(v, ncvar, out)
+                out.variables[v][:] = data
+
+        else:
+            self.create_variable(out, v, ncvar.dtype, ncvar.dimensions)
+            if len(ncvar.dimensions) == 2:
+                out.variables[v][:,:] = data
+            elif len(ncvar.dimensions) in [3, 4]:
+                data = np.ma.getdata(data)
+                for (st, en, idx, yr_pos) in \
+                    self.iter_gather_chunks(yr_seq, year_slices):
+                    out.variables[v][st:en] = data[idx]
+            out = self.write_attributes(v, ncvar, out)
+
+    def create_forcing_variables(self, out):
 
         #ndim = 1
         #out.createDimension('z', ndim)
 
         for v in ["CO2air", "Ndep", "Pdep"]:
-            out.createVariable(v, 'float32', ('time', 'y', 'x'))
+            self.create_variable(out, v, 'float32', ('time', 'y', 'x'))
+
+    def create_variable(self, out, v, dtype, dims):
+        """
+        Create a variable in the output file with our compression and
+        chunking settings. Chunks span time_chunk timesteps and the whole of
+        every other dimension, which suits CABLE reading the file
+        sequentially in time.
+        """
+        kwargs = {}
+        if self.zlib:
+            kwargs["zlib"] = True
+            kwargs["complevel"] = self.complevel
+            kwargs["shuffle"] = self.shuffle
+        if self.time_chunk is not None and "time" in dims:
+            sizes = [out.dimensions[d].size for d in dims]
+            kwargs["chunksizes"] = [min(self.time_chunk, sz) if d == "time" \
+                                        else sz for (d, sz) in zip(dims, sizes)]
+
+        return out.createVariable(v, dtype, dims, **kwargs)
+
+    def write_forcing_attributes(self, out):
 
-        # Add CO2, NDEP & PDEP
-        df = pd.read_csv(self.co2_ndep_fname, sep=';')
-
-        cnt1 = 0
-        cnt2 = 0
-        cx = np.zeros((n,1,1))
-        nx = np.zeros((n,1,1))
-        px = np.zeros((n,1,1))
-        y = start_yr
-        for yr in yr_sequence:
-            idx = np.argwhere(years==yr)
-            st = idx[0][0]
-            en = idx[-1][0] + 1
-            slice = ds.variables["SWdown"][st:en,:,:]
-            cnt2 += len(slice)
-            #print(y, st, en, cnt1, cnt2, n)
-            cx[cnt1:cnt2,:] = df[df.Year == y]["CO2 [ppm]"].values[0]
-            nx[cnt1:cnt2,:] = df[df.Year == y]["ndepo [kgN/ha/yr]"].values[0]
-            px[cnt1:cnt2,:] = df[df.Year == y]["pdepo [kgP/ha/yr]"].values[0]
-            cnt1 += len(slice)
-            y += 1
-
-        out.variables["CO2air"][:,:,:] = cx
         out.variables["CO2air"].setncatts({'units': "ppm"})
         out.variables["CO2air"].setncatts({'missing_value': "-9999"})
         out.variables["CO2air"].setncatts({'long_name':
                                            "Atmosphereic CO2 concentration"})
 
-        # kg ha-1 y-1 -> gN m-2 d-1
-        conv = self.KG_2_G / self.HA_2_M2 / self.YR_2_DAY
-        out.variables["Ndep"][:,:,:] = nx * conv
         out.variables["Ndep"].setncatts({'units': "gN/m^2/d^1"})
         out.variables["Ndep"].setncatts({'missing_value': "-9999"})
         out.variables["Ndep"].setncatts({'long_name': "N deposition"})
 
-        out.variables["Pdep"][:,:,:] = px * conv
         out.variables["Pdep"].setncatts({'units': "gP/m^2/d^1"})
         out.variables["Pdep"].setncatts({'missing_value': "-9999"})
         out.variables["Pdep"].setncatts({'long_name': "P deposition"})
 
-        # write global attributes
-        for ncattr in ds.ncattrs():
-            if ncattr != "_NCProperties":
-                out.setncattr(ncattr, getattr(ds, ncattr))
-
-        ds.close()
-        out.close()
-
-
 
     def check_differences(self, ofname):
         ds1 = nc.Dataset(self.met_fname)
@@ -415,41 +409,276 @@ class GenerateMetFiles(object):
 
         return out
 
+    def get_year_slice_table(self, years):
+        """
+        Build a lookup of year -> (start, end) position on the time axis of
+        the met file. The met file is ordered in time, so each year is one
+        contiguous block.
+        """
+        (yrs, starts, counts) = np.unique(years, return_index=True,
+                                          return_counts=True)
+
+        return {yr: (st, st + cnt) for yr, st, cnt in zip(yrs, starts, counts)}
+
+    def iter_gather_chunks(self, yr_seq, year_slices):
+        """
+        Walk the new (recycled) record in chunks of self.chunk_size timesteps.
+
+        For each chunk yields the (start, end) rows in the new file, the index
+        of the matching timesteps in the original met file and the position
+        of each row's year in yr_seq (for looking up annual forcing). The
+        indices are generated per chunk, so memory use doesn't grow with the
+        length of the transient period.
+        """
+        (starts, offsets) = self.get_gather_offsets(yr_seq, year_slices)
+        n = offsets[-1]
+
+        chunk_size = n if self.chunk_size is None else self.chunk_size
+        for st in range(0, n, chunk_size):
+            en = min(st + chunk_size, n)
+            (idx, yr_pos) = self.get_gather_rows(starts, offsets, st, en)
+
+            yield (st, en, idx, yr_pos)
+
+    def get_gather_offsets(self, yr_seq, year_slices):
+        """
+        Start of each recycled year in the original met file and in the new
+        file (offsets has one extra element, the length of the new file).
+        """
+        starts = np.asarray([year_slices[yr][0] for yr in yr_seq])
+        nsteps = np.asarray([year_slices[yr][1] - year_slices[yr][0] \
+                                for yr in yr_seq])
+        offsets = np.concatenate(([0], np.cumsum(nsteps)))
+
+        return (starts, offsets)
+
+    def get_gather_rows(self, starts, offsets, st, en):
+        """
+        For rows st:en of the new file, the matching timesteps in the
+        original met file and the position of each row's year in yr_seq.
+        """
+        rows = np.arange(st, en)
+        yr_pos = np.searchsorted(offsets, rows, side="right") - 1
+        idx = starts[yr_pos] + rows - offsets[yr_pos]
+
+        return (idx, yr_pos)
+
     def get_leap_sequence_of_years(self, start_yr, end_yr):
+        """
+        Sequence of met years used to fill the transient period, see
+        get_year_mapping.
+        """
+        year_map = get_year_mapping(start_yr, end_yr, cache_dir=self.cache_dir)
 
-        pre_industrial = 1850
+        return year_map[:,0], year_map[:,1]
 
-        # Set the seed so we can repeat this if required
-        np.random.seed(42)
 
-        # length of met record
-        nrec = end_yr - start_yr
+class ForcingTable(object):
+    """
+    Annual CO2, Ndep & Pdep forcing (e.g. the AmaFACE csv), held as arrays
+    indexed by year. Ndep & Pdep are converted from kg ha-1 yr-1 to
+    g m-2 d-1 when the table is loaded, so lookups need no further work.
+    """
 
-        req_yrs = start_yr - pre_industrial - 1
+    def __init__(self, fname):
 
-        # number of times met data is recycled during transient simulation
-        nloop_transient = int(np.ceil(req_yrs / nrec))
+        KG_2_G = 1000.0
+        HA_2_M2 = 10000.0
+        YR_2_DAY = 365.0
 
-        # Create a big sequence of years.
-        seq = np.tile(np.tile(np.arange(start_yr, end_yr),
-                        nloop_transient), 20)
+        df = pd.read_csv(fname, sep=';')
+        df = df.sort_values("Year")
 
-        i = 0
-        yr_seq = np.zeros(0)
-        actual_yrs = np.zeros(0)
-        for yr in np.arange(pre_industrial, start_yr):
-            year = seq[i]
+        self.fname = fname
+        self.years = df.Year.values.astype(int)
+        self.co2 = df["CO2 [ppm]"].values.astype(np.float64)
 
-            if calendar.isleap(yr):
+        # kg ha-1 y-1 -> gN m-2 d-1
+        conv = KG_2_G / HA_2_M2 / YR_2_DAY
+        self.ndep = df["ndepo [kgN/ha/yr]"].values.astype(np.float64) * conv
+        self.pdep = df["pdepo [kgP/ha/yr]"].values.astype(np.float64) * conv
 
-                while calendar.isleap(year) == False:
-                    i += 1
-                    year = seq[i]
-            i += 1
+    def lookup(self, years):
+        """
+        CO2 (ppm), Ndep (gN m-2 d-1) and Pdep (gP m-2 d-1) for each year in
+        years.
+        """
+        years = np.asarray(years, dtype=int)
+        idx = np.searchsorted(self.years, years)
+        idx = np.minimum(idx, len(self.years) - 1)
+        if np.any(self.years[idx] != years):
+            missing = np.unique(years[self.years[idx] != years])
+            raise ValueError("Years %s missing from %s" % \
+                                (missing, self.fname))
+
+        return (self.co2[idx], self.ndep[idx], self.pdep[idx])
+
+
+# forcing filename -> ForcingTable, so the csv is read & converted once per
+# process, however many sites/files we generate
+_forcing_tables = {}
+
+def get_forcing_table(fname):
+    """
+    Return the (shared) ForcingTable for fname, re-reading it only if the
+    file has changed.
+    """
+    key = os.path.abspath(fname)
+    mtime = os.path.getmtime(fname)
+    if key not in _forcing_tables or _forcing_tables[key][0] != mtime:
+        _forcing_tables[key] = (mtime, ForcingTable(fname))
+
+    return _forcing_tables[key][1]
+
+
+class TransientMet(object):
+    """
+    Reader for a transient descriptor (see
+    GenerateMetFiles.create_transient_descriptor). Time slices of the
+    transient record are built on demand from the original met file, so the
+    full transient file only needs to exist while CABLE is running.
+    """
+
+    def __init__(self, descriptor_fname, chunk_size=175200, nc_options=None):
+
+        with open(descriptor_fname, "r") as f:
+            descriptor = json.load(f)
+
+        self.site = descriptor["site"]
+        self.met_fname = descriptor["met_fname"]
+        self.co2_ndep_fname = descriptor["co2_ndep_fname"]
+        self.year_map = np.asarray(descriptor["year_map"], dtype=np.int16)
+        self.forcing = {v: np.asarray(descriptor[v]) \
+                            for v in ["CO2air", "Ndep", "Pdep"]}
+        if nc_options is None:
+            nc_options = {}
+        self.G = GenerateMetFiles(self.site, self.met_fname,
+                                  self.co2_ndep_fname, chunk_size=chunk_size,
+                                  **nc_options)
+
+        self.ds = nc.Dataset(self.met_fname)
+        time = nc.num2date(self.ds.variables['time'][:],
+                           self.ds.variables['time'].units)
+        orig_years = np.asarray([i.year for i in time])
+        year_slices = self.G.get_year_slice_table(orig_years)
+        (self.starts,
+         self.offsets) = self.G.get_gather_offsets(self.year_map[:,1],
+                                                   year_slices)
+        self.ntime = int(self.offsets[-1])
+        self.jump = self.ds.variables['time'][1] - \
+                        self.ds.variables['time'][0]
+
+    def read(self, v, st=0, en=None):
+        """
+        Rows st:en of variable v in the transient record
+        """
+        if en is None:
+            en = self.ntime
+        (idx, yr_pos) = self.G.get_gather_rows(self.starts, self.offsets,
+                                               st, en)
+
+        if v == "time":
+            return np.arange(st, en) * self.jump
+        elif v in self.forcing:
+            return self.forcing[v][yr_pos].reshape(-1,1,1)
+
+        ncvar = self.ds.variables[v]
+        if len(ncvar.dimensions) < 3:
+            return ncvar[:]
 
-            yr_seq = np.append(yr_seq, year)
-            actual_yrs = np.append(actual_yrs, yr)
-        return actual_yrs, yr_seq
+        # only read the block of the original record this slice touches
+        lo = idx.min()
+        hi = idx.max() + 1
+        data = np.ma.getdata(ncvar[lo:hi])
+
+        return data[idx - lo]
+
+    def materialise(self, ofname):
+        """
+        Write the full transient met file, as CABLE needs to read it
+        """
+        forcing = (self.forcing["CO2air"], self.forcing["Ndep"],
+                   self.forcing["Pdep"])
+        self.G.create_all(fname_trans=ofname, year_map=self.year_map,
+                          annual_forcing=forcing)
+
+    def close(self):
+        self.ds.close()
+
+
+# (start_yr, end_yr, pre_industrial) -> year mapping, so every site and
+# biogeochem cycle in a process shares the same table
+_year_mappings = {}
+
+def get_year_mapping(start_yr, end_yr, pre_industrial=1850, cache_dir=None):
+    """
+    Map each year of the transient period (pre_industrial to start_yr-1) onto
+    a year of the met record, which is recycled in order. Leap years are
+    always mapped onto a leap year of the met record, so a leap year target
+    skips forward to the next leap year in the record.
+
+    The mapping is deterministic, so it is only built once per
+    (start_yr, end_yr, pre_industrial) and, if cache_dir is given, saved
+    there for any other process to reuse.
+
+    Returns:
+    --------
+    year_map : int16 array, shape (nyears, 2)
+        (target_year, source_year) pairs
+    """
+    key = (start_yr, end_yr, pre_industrial)
+    if key in _year_mappings:
+        return _year_mappings[key]
+
+    if cache_dir is not None:
+        fname = os.path.join(cache_dir, "year_map_%d_%d_%d.npy" % \
+                                (pre_industrial, start_yr, end_yr))
+        if os.path.isfile(fname):
+            _year_mappings[key] = np.load(fname)
+            return _year_mappings[key]
+
+    # Met years we recycle, the final year of the met record is excluded as
+    # PALS met files only have a single timestep in their final year
+    record = np.arange(start_yr, end_yr)
+    nrec = len(record)
+    is_leap = np.asarray([calendar.isleap(yr) for yr in record])
+
+    # Distance from each position in the (cyclic) record to the next leap
+    # year, built in a single backward sweep over two cycles
+    to_leap = np.zeros(nrec, dtype=int)
+    dist = None
+    for k in range(2 * nrec - 1, -1, -1):
+        if is_leap[k % nrec]:
+            dist = 0
+        elif dist is not None:
+            dist += 1
+        if k < nrec:
+            to_leap[k] = -1 if dist is None else dist
+
+    targets = np.arange(pre_industrial, start_yr)
+    year_map = np.zeros((len(targets), 2), dtype=np.int16)
+    i = 0
+    for j, yr in enumerate(targets):
+        if calendar.isleap(yr):
+            if to_leap[i % nrec] < 0:
+                raise ValueError("No leap year in the met record (%d-%d)" % \
+                                    (start_yr, end_yr))
+            i += to_leap[i % nrec]
+        year_map[j,0] = yr
+        year_map[j,1] = record[i % nrec]
+        i += 1
+
+    if cache_dir is not None:
+        # Write to a tmp file and rename, so a concurrent reader never sees a
+        # partial file
+        tmp_fname = "%s.%d.tmp" % (fname, os.getpid())
+        with open(tmp_fname, "wb") as f:
+            np.save(f, year_map)
+        os.replace(tmp_fname, fname)
+
+    _year_mappings[key] = year_map
+
+    return year_map
 
 
 if __name__ == "__main__":
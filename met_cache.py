@@ -0,0 +1,264 @@
+#!/usr/bin/env python
+
+"""
+Content-addressed cache for the met files we derive for CABLE-CNP (spin,
+transient and simulation files, see generate_cable_met_files.py).
+
+Each set of derived files is stored in its own directory named after a hash
+of everything that goes into making them: the checksum of the source met
+file, the checksum of the CO2/Ndep/Pdep csv, the fixed spin-up CO2/Ndep/Pdep,
+the pre-industrial year and the generator version (GENERATOR_VERSION in
+generate_cable_met_files.py). So identical inputs are shared across
+experiments (and machines, if the cache dir is shared) and changing any
+input just means a new entry gets made, rather than silently reusing stale
+files. A manifest.json in the cache dir records what each entry was made
+from.
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import json
+import fcntl
+import shutil
+import hashlib
+import datetime as dt
+
+import generate_cable_met_files
+from generate_cable_met_files import GenerateMetFiles
+
+
+class MetFileCache(object):
+
+    def __init__(self, cache_dir="met_cache", pre_industrial=1850,
+                 nc_options=None):
+
+        self.cache_dir = cache_dir
+        self.pre_industrial = pre_industrial
+        # compression/chunking passed to GenerateMetFiles, e.g.
+        # {"zlib": True, "complevel": 1, "time_chunk": 17520}
+        if nc_options is None:
+            nc_options = {}
+        self.nc_options = nc_options
+        self.manifest_fname = os.path.join(self.cache_dir, "manifest.json")
+        self.manifest_lock = os.path.join(self.cache_dir, "manifest.lock")
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir, exist_ok=True)
+
+    def get_met_files(self, site, met_fname, co2_ndep_fname, co2_fixed,
+                      ndep_fixed, pdep_fixed, virtual_transient=False):
+        """
+        Return the (spin, transient, simulation) met files for these inputs,
+        generating them (in a single pass) if they aren't already cached.
+
+        If virtual_transient, the transient "file" is a small descriptor
+        (see generate_cable_met_files.TransientMet) that needs to be
+        materialised before CABLE can use it.
+        """
+        params = self.get_params(met_fname, co2_ndep_fname, co2_fixed,
+                                 ndep_fixed, pdep_fixed)
+        key = self.get_key(params)
+        entry_dir = os.path.join(self.cache_dir, key)
+        fnames = self.get_entry_fnames(entry_dir, virtual_transient)
+
+        if self.is_complete(fnames):
+            return fnames
+
+        # Only one process builds a given entry, anyone else asking for it
+        # waits here and then finds it complete
+        with self.lock(os.path.join(self.cache_dir, "%s.lock" % (key))):
+            if not self.is_complete(fnames):
+                self.build_entry(site, met_fname, co2_ndep_fname, co2_fixed,
+                                 ndep_fixed, pdep_fixed, entry_dir,
+                                 virtual_transient)
+                params["site"] = site
+                self.add_to_manifest(key, params)
+
+        return fnames
+
+    def get_params(self, met_fname, co2_ndep_fname, co2_fixed, ndep_fixed,
+                   pdep_fixed):
+        """
+        Everything that determines the contents of the derived met files
+        """
+        params = {
+            "met_fname": os.path.abspath(met_fname),
+            "met_checksum": self.checksum(met_fname),
+            "co2_ndep_fname": os.path.abspath(co2_ndep_fname),
+            "co2_ndep_checksum": self.checksum(co2_ndep_fname),
+            "co2_fixed": float(co2_fixed),
+            "ndep_fixed": float(ndep_fixed),
+            "pdep_fixed": float(pdep_fixed),
+            "pre_industrial": self.pre_industrial,
+            "generator_version": generate_cable_met_files.GENERATOR_VERSION,
+        }
+        if self.nc_options:
+            params["nc_options"] = self.nc_options
+
+        return params
+
+    def get_key(self, params):
+        """
+        Hash of the inputs, ignoring where the files happen to live so the
+        same inputs on another machine map to the same entry
+        """
+        hashed = {k: v for k, v in params.items() \
+                    if k not in ["met_fname", "co2_ndep_fname"]}
+        s = json.dumps(hashed, sort_keys=True)
+
+        # 16 hex chars is plenty and keeps paths short enough for the
+        # namelist
+        return hashlib.sha256(s.encode()).hexdigest()[:16]
+
+    def get_entry_fnames(self, entry_dir, virtual_transient=False):
+
+        fname_spin = os.path.join(entry_dir, "met_spin.nc")
+        if virtual_transient:
+            fname_trans = os.path.join(entry_dir, "met_trans.json")
+        else:
+            fname_trans = os.path.join(entry_dir, "met_trans.nc")
+        fname_sim = os.path.join(entry_dir, "met_simulation.nc")
+
+        return (fname_spin, fname_trans, fname_sim)
+
+    def is_complete(self, fnames):
+        return all([os.path.isfile(f) for f in fnames])
+
+    def build_entry(self, site, met_fname, co2_ndep_fname, co2_fixed,
+                    ndep_fixed, pdep_fixed, entry_dir, virtual_transient=False):
+        """
+        Generate whichever files the entry is missing in a tmp dir and rename
+        each into place, so a file in the entry is always complete
+        """
+        tmp_dir = "%s.%d.tmp" % (entry_dir, os.getpid())
+        if os.path.exists(tmp_dir):
+            shutil.rmtree(tmp_dir)
+        os.makedirs(tmp_dir)
+        if not os.path.exists(entry_dir):
+            os.makedirs(entry_dir)
+
+        fnames = self.get_entry_fnames(entry_dir, virtual_transient)
+        tmp_fnames = self.get_entry_fnames(tmp_dir, virtual_transient)
+        todo = [None if os.path.isfile(f) else tmp_f \
+                    for (f, tmp_f) in zip(fnames, tmp_fnames)]
+
+        G = GenerateMetFiles(site, met_fname, co2_ndep_fname,
+                             cache_dir=self.cache_dir, **self.nc_options)
+        if virtual_transient:
+            if todo[1] is not None:
+                G.create_transient_descriptor(todo[1])
+            todo[1] = None
+        if any(todo):
+            G.create_all(todo[0], todo[1], todo[2], co2_fixed, ndep_fixed,
+                         pdep_fixed)
+
+        for (f, tmp_f) in zip(fnames, tmp_fnames):
+            if os.path.isfile(tmp_f):
+                os.replace(tmp_f, f)
+        shutil.rmtree(tmp_dir)
+
+    def checksum(self, fname):
+        """
+        sha256 of a file. Met files are big, so the checksum is remembered in
+        the manifest against the file's path, size and modification time and
+        only recomputed if the file changes.
+        """
+        path = os.path.abspath(fname)
+        stat = os.stat(path)
+
+        manifest = self.read_manifest()
+        known = manifest["checksums"].get(path)
+        if known is not None and known["size"] == stat.st_size and \
+           known["mtime"] == stat.st_mtime:
+            return known["sha256"]
+
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                h.update(block)
+        digest = h.hexdigest()
+
+        with self.lock(self.manifest_lock):
+            manifest = self.read_manifest()
+            manifest["checksums"][path] = {"size": stat.st_size,
+                                           "mtime": stat.st_mtime,
+                                           "sha256": digest}
+            self.write_manifest(manifest)
+
+        return digest
+
+    def add_to_manifest(self, key, params):
+
+        params["created"] = dt.datetime.now().isoformat(timespec="seconds")
+        with self.lock(self.manifest_lock):
+            manifest = self.read_manifest()
+            manifest["entries"][key] = params
+            self.write_manifest(manifest)
+
+    def read_manifest(self):
+
+        if not os.path.isfile(self.manifest_fname):
+            return {"entries": {}, "checksums": {}}
+
+        with open(self.manifest_fname, "r") as f:
+            manifest = json.load(f)
+
+        return manifest
+
+    def write_manifest(self, manifest):
+
+        tmp_fname = "%s.%d.tmp" % (self.manifest_fname, os.getpid())
+        with open(tmp_fname, "w") as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_fname, self.manifest_fname)
+
+    def lock(self, lock_fname):
+        return FileLock(lock_fname)
+
+
+class FileLock(object):
+    """
+    Exclusive lock on a file, held for the duration of a with block. Works
+    across processes on the same machine and on shared filesystems that
+    support flock.
+    """
+
+    def __init__(self, fname):
+        self.fname = fname
+        self.fp = None
+
+    def __enter__(self):
+        self.fp = open(self.fname, "a")
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_EX)
+        return self
+
+    def __exit__(self, *args):
+        fcntl.flock(self.fp.fileno(), fcntl.LOCK_UN)
+        self.fp.close()
+        self.fp = None
+
+
+if __name__ == "__main__":
+
+    site = "AU-Tum"
+    met_dir = "met"
+    co2_ndep_dir = "co2_ndep"
+    met_fname = os.path.join(met_dir, "AU-Tum_2002-2016_OzFlux_Met.nc")
+    co2_ndep_fn = "AmaFACE_co2npdepforcing_1850_2100_AMB.csv"
+    co2_ndep_fname = os.path.join(co2_ndep_dir, co2_ndep_fn)
+
+    co2_fixed = 284.7  # umol mol-1
+    ndep_fixed = 0.79  # kg N ha-1 yr-1
+    pdep_fixed = 0.144 # kg N ha-1 yr-1
+
+    M = MetFileCache("met_cache")
+    (fname_spin,
+     fname_trans,
+     fname_sim) = M.get_met_files(site, met_fname, co2_ndep_fname, co2_fixed,
+                                  ndep_fixed, pdep_fixed)
+    print(fname_spin, fname_trans, fname_sim)
@@ -10,17 +10,12 @@ __version__ = "1.0 (07.02.2020)"
 __email__ = "mdekauwe@gmail.com"
 
 import matplotlib.pyplot as plt
-import sys
-import datetime as dt
-import pandas as pd
-import numpy as np
-from matplotlib.ticker import FixedLocator
 import os
-import xarray as xr
-import glob
+
+from spin_ledger import SpinLedger
 
 def plot_spinup_state(cycle, cf, cw, cr, ca, cs, cp, co2, ndep, pdep,
-                      gpp, npp, nep):
+                      gpp, npp, nep, checks=None):
 
     fig = plt.figure(figsize=(15,6))
     fig.subplots_adjust(hspace=0.3)
@@ -83,6 +78,16 @@ def plot_spinup_state(cycle, cf, cw, cr, ca, cs, cp, co2, ndep, pdep,
     ax12.set_title("NEP (g C m$^{-2}$)")
     ax12.plot(nep)
 
+    # Mark where the steady-state checks were made on the pools, those that
+    # passed filled
+    if checks is not None:
+        for (ax, col) in [(ax1, "cf"), (ax2, "cw"), (ax3, "cr"), (ax4, "ca"),
+                          (ax5, "cs"), (ax6, "cp")]:
+            passed = checks[checks.converged == True]
+            ax.plot(checks[col], ls="none", marker="o", mfc="none",
+                    color="red")
+            ax.plot(passed[col], ls="none", marker="o", color="red")
+
     #plot_fname = "%s_spinup_carbon_pools.pdf" % (cycle)
     plot_fname = "%s_spinup_carbon_pools.png" % (cycle)
     plot_dir = "plots"
@@ -96,75 +101,24 @@ def plot_spinup_state(cycle, cf, cw, cr, ca, cs, cp, co2, ndep, pdep,
 
 
 
-def get_data(casa_fname, cable_fname):
-
-    ds = xr.open_dataset(casa_fname)
-    csoil = ds.csoil[-1,:,0]
-    cplant = ds.cplant[-1,:,0]
-    ndep = ds.Nmindep[-1,0]
-    pdep = ds.Pdep[-1,0]
-    gpp = np.mean(ds.Cgpp[:,0])
-    npp = np.mean(ds.Cnpp[:,0])
-    nep = np.mean(ds.Cnep[:,0])
-
-    ds = xr.open_dataset(cable_fname, decode_times=False)
-    co2 = ds.CO2air[-1,0,0]
-
-
-    return (cplant, csoil, co2, ndep, pdep, gpp, npp, nep)
-
-
 if __name__ == "__main__":
 
 
     site = "AU-Tum"
     year = 1850
+    ledger_fname = "logs/spin_ledger.csv"
 
-    cf = []
-    cw = []
-    cr = []
-
-    ca = []
-    cs = []
-    cp = []
-
-    co2 = []
-    ndep = []
-    pdep = []
-
-    gpp = []
-    npp = []
-    nep = []
+    # The state at the end of each spin is in the spin ledger written by the
+    # run scripts, see spin_ledger.py
+    L = SpinLedger(ledger_fname)
 
     #for cycle in ["CN"]:
     for cycle in ["C"]:
     #for cycle in ["C", "CN", "CNP"]:
-        files = glob.glob("outputs/%s_%s_out_casa_spin_*.nc" % (site, cycle))
-        nums = sorted([int(f.split(".")[0].split("_")[-1]) for f in files])
-
-        for i in range(nums[0], nums[-1]):
-            print(cycle, i, nums[-1])
-            casa_fn = "outputs/%s_%s_out_casa_spin_%d.nc" % (site, cycle, i)
-            cable_fn = "outputs/%s_%s_out_cable_spin_%d.nc" % (site, cycle, i)
-
-            (cplant, csoil, co2x, ndepx, pdepx,
-             gppx, nppx, nepx) = get_data(casa_fn, cable_fn)
-
-            gpp.append(gppx)
-            npp.append(nppx)
-            nep.append(nepx)
-
-            cf.append(cplant[0])
-            cw.append(cplant[1])
-            cr.append(cplant[2])
-
-            ca.append(csoil[0])
-            cs.append(csoil[1])
-            cp.append(csoil[2])
-
-            co2.append(co2x)
-            ndep.append(ndepx * 365.)
-            pdep.append(pdepx * 365.)
+        df = L.spin_history(site, cycle)
+        checks = L.check_history(site, cycle)
+        print(cycle, len(df), len(checks))
 
-        plot_spinup_state(cycle, cf, cw, cr, ca, cs, cp, co2, ndep, pdep,
-                          gpp, npp, nep)
+        plot_spinup_state(cycle, df.cf, df.cw, df.cr, df.ca, df.cs, df.cp,
+                          df.co2, df.ndep * 365., df.pdep * 365.,
+                          df.gpp, df.npp, df.nep, checks=checks)
@@ -0,0 +1,1197 @@
+#!/usr/bin/env python
+
+"""
+The machinery shared by the CABLE site runners (run_cable_site_CNP.py and
+run_cable_site_CNP_brute_spin.py): setting up each site's working dir and
+namelist, running CABLE, the state file we resume from, the spin controller
+and ledger, scheduling sites across cores, the C -> CN -> CNP pipeline and
+reporting. Each runner subclasses RunCableBase and supplies its PHASES and
+spin_site, i.e. how it spins a site up, along with the namelist settings for
+its runs (inital_spin_setup, setup_spin, setup_simulation).
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import glob
+import json
+import time
+import queue
+import datetime as dt
+import shutil
+import tempfile
+import traceback
+import multiprocessing as mp
+import numpy as np
+import pandas as pd
+
+from cable_utils import Namelist
+from cable_utils import get_svn_info
+from cable_utils import move_file
+from cable_utils import check_steady_state
+from cable_utils import extrapolate_casa_restart
+from cable_utils import get_casa_pools
+from met_cache import MetFileCache
+from met_cache import FileLock
+from generate_cable_met_files import TransientMet
+from cable_executor import CableExecutor
+from cable_executor import CableRunError
+from spin_controller import SpinController
+from spin_controller import SpinAborted
+from spin_ledger import SpinLedger
+from spin_ledger import read_run_diagnostics
+
+
+class RunCableBase(object):
+
+    # The steps each site goes through, in order, see spin_site
+    PHASES = []
+
+    def __init__(self, met_dir=None, log_dir=None, output_dir=None,
+                 restart_dir=None, aux_dir=None, namelist_dir=None,
+                 nml_fname="cable.nml", dump_dir=None,
+                 veg_fname="def_veg_params_zr_clitt_albedo_fix.txt",
+                 soil_fname="def_soil_params.txt",
+                 grid_fname="gridinfo_CSIRO_1x1.nc",
+                 phen_fname="modis_phenology_csiro.txt",
+                 #cnpbiome_fname="pftlookup_csiro_v16_17tiles_Ticket2.csv",
+                 cnpbiome_fname="pftlookup_csiro_v16_17tiles-cheng-m02.csv",
+                 elev_fname="GSWP3_gwmodel_parameters.nc",
+                 biogeochem="C", co2_ndep_dir=None,
+                 lai_dir=None, fixed_lai=None, co2_conc=400.0, co2_fixed=284.7,
+                 ndep_fixed=0.79, pdep_fixed=0.144,met_subset=[],
+                 cable_src=None, cable_exe="cable", mpi=True,
+                 num_cores=None, verbose=True, met_cache_dir="met_cache",
+                 virtual_transient=False, scratch_dir=None,
+                 met_nc_options=None, met_prefetch_workers=1,
+                 nml_template=False, resume=False, run_timeouts=None,
+                 max_retries=1, accelerate=False, spin_control=None,
+                 forcing="AMB", speculate=None):
+
+        self.met_dir = met_dir
+        self.dump_dir = dump_dir
+        self.log_dir = log_dir
+        self.output_dir = output_dir
+        self.restart_dir = restart_dir
+        self.aux_dir = aux_dir
+        self.namelist_dir = namelist_dir
+        self.co2_ndep_dir = co2_ndep_dir
+        self.nml_fname = nml_fname
+        self.base_nml_fname = nml_fname
+        self.biogeophys_dir = os.path.join(self.aux_dir, "core/biogeophys")
+        self.grid_dir = os.path.join(self.aux_dir, "offline")
+        self.biogeochem_dir = os.path.join(self.aux_dir, "core/biogeochem/")
+        self.veg_fname = os.path.join(self.biogeophys_dir, veg_fname)
+        self.soil_fname = os.path.join(self.biogeophys_dir, soil_fname)
+        self.grid_fname = os.path.join(self.grid_dir, grid_fname)
+        self.phen_fname = os.path.join(self.biogeochem_dir, phen_fname)
+        #self.cnpbiome_fname = os.path.join(self.biogeochem_dir, cnpbiome_fname)
+        self.cnpbiome_fname = os.path.join("CNP_param_file", cnpbiome_fname)
+        self.elev_fname = elev_fname
+        self.co2_conc = co2_conc
+        self.met_subset = met_subset
+        self.cable_src = cable_src
+        self.cable_exe = os.path.join(cable_src, "offline/%s" % (cable_exe))
+        self.verbose = verbose
+        self.mpi = mpi
+        self.num_cores = num_cores
+        self.lai_dir = lai_dir
+        self.fixed_lai = fixed_lai
+        self.biogeochem_cyc = biogeochem
+        self.co2_fixed = co2_fixed    # umol mol-1
+        self.ndep_fixed = ndep_fixed  # kg N ha-1 yr-1
+        self.pdep_fixed = pdep_fixed  # kg N ha-1 yr-1
+        self.met_cache_dir = met_cache_dir
+        # Only keep a descriptor of the transient met file, which is written
+        # out to the scratch dir for the historical run
+        self.virtual_transient = virtual_transient
+        if scratch_dir is None:
+            scratch_dir = os.environ.get("PBS_JOBFS", tempfile.gettempdir())
+        self.scratch_dir = scratch_dir
+        # compression/chunking of the generated met files, see
+        # benchmark_met_compression.py
+        self.met_nc_options = met_nc_options
+        # Number of processes preparing met files in the background, ahead
+        # of the model runs. 0 generates them inline before each site.
+        self.met_prefetch_workers = met_prefetch_workers
+        # Write a separate namelist for every run into the namelist dir,
+        # rather than editing a single namelist per site in place
+        self.nml_template = nml_template
+        # Number of runs each site needed last time, used to start the
+        # slowest sites first
+        self.spin_counts_fname = os.path.join(self.log_dir, "spin_counts.json")
+        # Carry on each site from where the last attempt got to (recorded in
+        # <restart_dir>/<experiment_id>_state.json) rather than starting over
+        self.resume = resume
+        # Wall-clock limit (seconds) for a single CABLE run in each phase, e.g.
+        # {"spin": 3600, "aspin": 3600, "historical": 7200}, after which the
+        # run is killed. Phases not listed can run for as long as they like.
+        if run_timeouts is None:
+            run_timeouts = {}
+        self.run_timeouts = run_timeouts
+        self.run_tag = None
+        self.executor = CableExecutor(echo=verbose)
+        # A failed CABLE run is retried (from the same restart) this many
+        # times before we give up on the site. Every failure is recorded in
+        # the failures ledger.
+        self.max_retries = max_retries
+        self.failures_fname = os.path.join(self.log_dir, "failures.csv")
+        self.summary_fname = os.path.join(self.log_dir, "campaign_summary.csv")
+        self.state = None
+        self.run_number = None
+        self.last_run = None
+        self.cable_runs = 0
+        self.earlier_runs = 0
+        # Every spin run and steady-state check in the campaign, see
+        # spin_ledger.py
+        self.ledger = SpinLedger(os.path.join(self.log_dir,
+                                              "spin_ledger.csv"))
+        # Extrapolate the pools from the last few spins towards steady state,
+        # see accelerate_spin
+        self.accelerate = accelerate
+        self.last_extrapolated = -1
+        # Decides how many spins to run between steady-state checks and
+        # holds the per-phase tolerance/iteration limits and the per-site
+        # budget of runs, see spin_controller.py
+        if spin_control is None:
+            spin_control = SpinController()
+        self.spin_control = spin_control
+        # CO2, Ndep and Pdep for the historical and simulation runs, from
+        # co2_ndep/AmaFACE_co2npdepforcing_1850_2100_<forcing>.csv. Anything
+        # other than ambient is added to the experiment_id.
+        self.forcing = forcing
+        # In pipeline mode, start the next cycle once the last spin phase's
+        # check is within speculate * tol of converging, see check_spin
+        self.speculate = speculate
+        self.speculative_num = None
+        self.speculative_tol = None
+        # Set in pipeline mode, see pipeline_worker
+        self.pipeline_queue = None
+        self.pipeline_cycles = None
+        self.pipeline_forcings = None
+        self.restart_published = False
+        self.speculative_branch = False
+        self.spun_up_from = None
+
+        self.set_cycle(self.biogeochem_cyc)
+
+    def set_cycle(self, biogeochem):
+
+        self.biogeochem_cyc = biogeochem
+        if self.biogeochem_cyc == "C":
+            self.biogeochem_id = 1
+            self.vcmax_feedback = ".FALSE."
+        elif self.biogeochem_cyc == "CN":
+            self.biogeochem_id = 2
+            self.vcmax_feedback = ".TRUE."
+        elif self.biogeochem_cyc == "CNP":
+            self.biogeochem_id = 3
+            self.vcmax_feedback = ".TRUE."
+
+    def get_experiment_id(self, site, cycle=None, forcing=None):
+
+        if cycle is None:
+            cycle = self.biogeochem_cyc
+        if forcing is None:
+            forcing = self.forcing
+
+        if forcing == "AMB":
+            return "%s_%s" % (site, cycle)
+        return "%s_%s_%s" % (site, cycle, forcing)
+
+    def main(self, sci_config, dont_have_restart=True, restart_num=None):
+
+        (met_files, url, rev) = self.initialise_stuff()
+
+        # Slowest sites first, so they aren't left running on their own at
+        # the end while the other cores sit idle
+        met_files = self.order_by_expected_work(met_files)
+
+        # Setup multi-processor jobs
+        if self.mpi:
+            if self.num_cores is None: # use them all!
+                self.num_cores = mp.cpu_count()
+            num_workers = min(self.num_cores, len(met_files))
+
+            # Sites are handed out one at a time from a shared queue, so a
+            # worker picks up the next site as soon as it finishes one
+            site_queue = mp.Queue()
+            for fname in met_files:
+                site_queue.put(fname)
+            for i in range(num_workers):
+                site_queue.put(None)
+            result_queue = mp.Queue()
+
+            processes = []
+            for i in range(num_workers):
+                p = mp.Process(target=self.queue_worker,
+                               args=(site_queue, result_queue, url, rev,
+                                     sci_config, dont_have_restart,
+                                     restart_num, ))
+                processes.append(p)
+
+            # Run processes
+            for p in processes:
+                p.start()
+
+            # Met files are prepared in the order the queue hands out sites
+            met_pool = self.start_met_prefetch(met_files)
+
+            results = []
+            while len(results) < len(met_files):
+                try:
+                    results.append(result_queue.get(timeout=60))
+                except queue.Empty:
+                    if not any([p.is_alive() for p in processes]):
+                        break
+
+            for p in processes:
+                p.join()
+        else:
+            met_pool = self.start_met_prefetch(met_files)
+            results = self.worker(met_files, url, rev, sci_config,
+                                  dont_have_restart, restart_num,)
+
+        if met_pool is not None:
+            met_pool.join()
+
+        self.record_spin_counts(results)
+        self.report_status(met_files, results)
+
+    def pipeline(self, sci_config, cycles=["C", "CN", "CNP"], forcings=None):
+        """
+        Run every site through the cycles in turn, each cycle starting from
+        the site's spun-up restart from the previous cycle. Each site's cycles
+        depend only on each other, so a site's CN spin starts as soon as its
+        C spin has converged (its C historical and simulation runs carry on
+        alongside), rather than once every site has finished C.
+
+        With several forcings, e.g. ["AMB", "ELE"], only the first is spun
+        up. The spin-up uses fixed CO2, Ndep and Pdep, so each of the others
+        starts its historical run from the first one's converged restart for
+        that cycle.
+
+        If speculate is set, the next cycle doesn't wait for convergence
+        either, see check_spin.
+        """
+        (met_files, url, rev) = self.initialise_stuff()
+        if forcings is None:
+            forcings = [self.forcing]
+
+        self.set_cycle(cycles[0])
+        self.forcing = forcings[0]
+        met_files = self.order_by_expected_work(met_files)
+
+        if self.num_cores is None: # use them all!
+            self.num_cores = mp.cpu_count()
+        if not self.mpi:
+            self.num_cores = 1
+
+        # The queue starts with the first cycle for each site, later cycles
+        # (and the other forcings) are added as their predecessor converges.
+        # Tasks are (met file, forcing, cycle, restart number, mode).
+        task_queue = mp.Queue()
+        for fname in met_files:
+            task_queue.put((fname, forcings[0], cycles[0], None, None))
+        result_queue = mp.Queue()
+
+        processes = []
+        for i in range(self.num_cores):
+            p = mp.Process(target=self.pipeline_worker,
+                           args=(task_queue, result_queue, cycles, forcings,
+                                 url, rev, sci_config, ))
+            processes.append(p)
+
+        # Run processes
+        for p in processes:
+            p.start()
+
+        met_pool = self.start_met_prefetch(met_files)
+
+        # Every cycle of every site ends up with a result, even if that is
+        # just that it was skipped because an earlier cycle failed
+        results = []
+        published = set()
+        speculative = {}
+        while len(results) < len(met_files) * len(cycles) * len(forcings):
+            try:
+                msg = result_queue.get(timeout=60)
+            except queue.Empty:
+                if not any([p.is_alive() for p in processes]):
+                    break
+                continue
+
+            self.pipeline_message(msg, task_queue, results, published,
+                                  speculative, cycles, forcings)
+
+        for p in processes:
+            task_queue.put(None)
+        for p in processes:
+            p.join()
+
+        if met_pool is not None:
+            met_pool.join()
+
+        self.record_spin_counts(results)
+        self.report_status(met_files, results)
+
+    def pipeline_message(self, msg, task_queue, results, published,
+                         speculative, cycles, forcings):
+        """
+        Act on a message from a pipeline worker. Messages from a speculative
+        branch are held back until we know whether the branch is kept.
+        """
+        (kind, fname, forcing, cycle) = msg[:4]
+        site = os.path.basename(fname).split(".")[0].split("_")[0]
+        i = cycles.index(cycle)
+
+        branch = None
+        if forcing == forcings[0]:
+            branch = speculative.get((fname, cycle))
+        if branch is not None and branch["status"] != "kept":
+            if branch["status"] == "running":
+                branch["messages"].append(msg)
+            elif kind == "done":
+                # an abandoned branch has stopped
+                self.restart_speculative(fname, cycle, speculative,
+                                         task_queue)
+            return
+
+        if kind == "speculative":
+            number = msg[4]
+            successor = cycles[i+1]
+            speculative[(fname, successor)] = {"status": "running",
+                                               "messages": [],
+                                               "start": number+1,
+                                               "restart_num": None}
+            task_queue.put((fname, forcing, successor, number+1,
+                            "speculative"))
+
+        elif kind == "converged":
+            (number, matches) = msg[4:]
+            published.add((fname, forcing, cycle))
+            if forcing != forcings[0]:
+                return
+
+            for other in forcings[1:]:
+                task_queue.put((fname, other, cycle, number+1, "transient"))
+
+            if i == len(cycles) - 1:
+                return
+            successor = cycles[i+1]
+            branch = speculative.get((fname, successor))
+            if branch is None:
+                task_queue.put((fname, forcing, successor, number+1, None))
+            elif matches:
+                branch["status"] = "kept"
+                for held in branch["messages"]:
+                    self.pipeline_message(held, task_queue, results,
+                                          published, speculative, cycles,
+                                          forcings)
+                branch["messages"] = []
+            else:
+                self.abort_speculative(fname, successor, number+1,
+                                       speculative, task_queue)
+
+        else:
+            result = msg[4]
+            results.append(result)
+            if (result[2] != "ok" and forcing == forcings[0] and
+                (fname, forcing, cycle) not in published):
+
+                # Nothing for the other forcings or later cycles to start from
+                for later in cycles[i:]:
+                    for other in forcings:
+                        if later != cycle or other != forcing:
+                            experiment_id = self.get_experiment_id(site, later,
+                                                                   other)
+                            results.append((fname, experiment_id, "skipped",
+                                            0, 0.0))
+                if (i < len(cycles) - 1 and
+                    (fname, cycles[i+1]) in speculative):
+                    self.abort_speculative(fname, cycles[i+1], None,
+                                           speculative, task_queue)
+
+    def abort_speculative(self, fname, cycle, restart_num, speculative,
+                          task_queue):
+        """
+        Give up on a speculative branch, starting it again from restart_num
+        once it has stopped (if there is something to start from)
+        """
+        site = os.path.basename(fname).split(".")[0].split("_")[0]
+        branch = speculative[(fname, cycle)]
+        branch["status"] = "aborted"
+        branch["restart_num"] = restart_num
+
+        if any([msg[0] == "done" for msg in branch["messages"]]):
+            self.restart_speculative(fname, cycle, speculative, task_queue)
+        else:
+            experiment_id = self.get_experiment_id(site, cycle)
+            open(self.abort_fname(experiment_id), "w").close()
+
+    def restart_speculative(self, fname, cycle, speculative, task_queue):
+
+        site = os.path.basename(fname).split(".")[0].split("_")[0]
+        branch = speculative.pop((fname, cycle))
+        experiment_id = self.get_experiment_id(site, cycle)
+
+        # Don't let the new run resume from what the old one got to
+        for f in [self.abort_fname(experiment_id),
+                  self.state_fname(experiment_id)]:
+            if os.path.isfile(f):
+                os.remove(f)
+
+        # nor leave the restarts the branch made lying around, bar the one
+        # the new run starts from (see publish_restart)
+        keep = None
+        if branch["restart_num"] is not None:
+            keep = branch["restart_num"] - 1
+        for rst_type in ["cable", "casa"]:
+            pattern = "%s_%s_rst_*.nc" % (experiment_id, rst_type)
+            for f in glob.glob(os.path.join(self.restart_dir, pattern)):
+                n = os.path.splitext(f)[0].rsplit("_", 1)[1]
+                if n.isdigit() and int(n) >= branch["start"] and int(n) != keep:
+                    os.remove(f)
+
+        if branch["restart_num"] is not None:
+            print("Restarting %s from restart %d" % \
+                    (experiment_id, branch["restart_num"]-1))
+            task_queue.put((fname, self.forcing, cycle,
+                            branch["restart_num"], None))
+
+    def pipeline_worker(self, task_queue, result_queue, cycles, forcings,
+                        url, rev, sci_config):
+        """
+        Keep taking (site, forcing, cycle, restart number, mode) tasks off
+        the queue until we're handed None
+        """
+        self.pipeline_queue = result_queue
+        self.pipeline_cycles = cycles
+        self.pipeline_forcings = forcings
+        while True:
+            task = task_queue.get()
+            if task is None:
+                break
+
+            (fname, forcing, cycle, restart_num, mode) = task
+            self.set_cycle(cycle)
+            self.forcing = forcing
+            self.restart_published = restart_num is not None
+            self.speculative_branch = mode == "speculative"
+            self.spun_up_from = None
+            if mode == "transient":
+                self.spun_up_from = restart_num - 1
+            result = self.run_site(fname, url, rev, sci_config,
+                                   restart_num is None, restart_num)
+            result_queue.put(("done", fname, forcing, cycle, result))
+
+    def publish_restart(self, fname, site, number, speculative=False):
+        """
+        In pipeline mode, copy the converged restart to the next cycle's
+        names (and the other forcings' for this cycle) and tell the parent
+        it can start them. The copy has to happen now, as the historical run
+        overwrites this restart.
+
+        If the next cycle has already been started speculatively, it is
+        kept if it started within tolerance of this restart. Otherwise it is
+        told to stop, and we wait for it to do so before copying over its
+        files.
+        """
+        if (self.pipeline_queue is None or
+            self.forcing != self.pipeline_forcings[0]):
+            return
+
+        i = self.pipeline_cycles.index(self.biogeochem_cyc)
+        successor_id = None
+        if i < len(self.pipeline_cycles) - 1:
+            successor_id = self.get_experiment_id(site,
+                                                  self.pipeline_cycles[i+1])
+
+        if speculative:
+            if successor_id is not None:
+                self.speculative_num = number
+                self.copy_restart(number, [successor_id])
+                self.pipeline_queue.put(("speculative", fname, self.forcing,
+                                         self.biogeochem_cyc, number))
+            return
+
+        targets = [self.get_experiment_id(site, self.biogeochem_cyc, f) \
+                    for f in self.pipeline_forcings[1:]]
+        matches = None
+        if self.speculative_num is not None:
+            matches = self.same_state(self.speculative_num, number)
+            print("Speculative %s from restart %d: %s" % \
+                    (successor_id, self.speculative_num,
+                     "kept" if matches else "abandoned"))
+
+        # If we've resumed past the historical run the restart will have
+        # been copied over when we first got here
+        if not self.phase_done("historical"):
+            self.copy_restart(number, targets)
+            if matches is None:
+                self.copy_restart(number, [successor_id])
+            elif not matches:
+                open(self.abort_fname(successor_id), "w").close()
+                with FileLock(self.running_fname(successor_id)):
+                    self.copy_restart(number, [successor_id])
+                self.remove_running_lock(successor_id)
+
+        self.pipeline_queue.put(("converged", fname, self.forcing,
+                                 self.biogeochem_cyc, number, matches))
+
+    def copy_restart(self, number, experiment_ids):
+
+        for experiment_id in experiment_ids:
+            if experiment_id is None:
+                continue
+            for rst_type in ["cable", "casa"]:
+                rst_fname = "%s_%s_rst_%d.nc" % \
+                                (self.experiment_id, rst_type, number)
+                new_rst_fname = "%s_%s_rst_%d.nc" % \
+                                (experiment_id, rst_type, number)
+                shutil.copy(os.path.join(self.restart_dir, rst_fname),
+                            os.path.join(self.restart_dir, new_rst_fname))
+
+    def speculate_restart(self, tol):
+        """
+        Close enough to steady state for the next cycle to make a start from
+        the last restart, see publish_restart. Once per site and cycle, and
+        never from a branch that is itself speculative.
+        """
+        if (self.pipeline_queue is None or self.speculative_branch or
+            self.speculative_num is not None or
+            self.spun_up_from is not None):
+            return
+
+        self.speculative_tol = tol
+        self.publish_restart(self.site_fname, self.site,
+                             self.state["restart_num"], speculative=True)
+
+    def same_state(self, old_num, num):
+        """
+        Is the soil C in restart num within tolerance of restart old_num
+        """
+        pools = []
+        for n in [old_num, num]:
+            casa_rst_fname = "%s_casa_rst_%d.nc" % (self.experiment_id, n)
+            pools.append(get_casa_pools(os.path.join(self.restart_dir,
+                                                     casa_rst_fname)))
+        (old, new) = pools
+        delta = np.fabs((new["csoil"] - old["csoil"]) / new["csoil"])
+
+        return delta < self.speculative_tol
+
+    def abort_fname(self, experiment_id):
+        return os.path.join(self.restart_dir, "%s_abort" % (experiment_id))
+
+    def running_fname(self, experiment_id):
+        return os.path.join(self.restart_dir,
+                            "%s_running.lock" % (experiment_id))
+
+    def remove_running_lock(self, experiment_id):
+        """
+        Once the branch has stopped, or we've waited for it to, nothing
+        needs the lock file
+        """
+        try:
+            os.remove(self.running_fname(experiment_id))
+        except FileNotFoundError:
+            pass
+
+    def check_abort(self):
+        """
+        A speculative branch stops before its next run once it's been told
+        to, see publish_restart
+        """
+        if (self.speculative_branch and
+            os.path.isfile(self.abort_fname(self.experiment_id))):
+            raise SpinAborted("%s: speculative start abandoned" % \
+                                (self.experiment_id))
+
+    def queue_worker(self, site_queue, result_queue, url, rev, sci_config,
+                     dont_have_restart, restart_num):
+        """
+        Keep taking sites off the queue until we're handed None
+        """
+        while True:
+            fname = site_queue.get()
+            if fname is None:
+                break
+            result_queue.put(self.run_site(fname, url, rev, sci_config,
+                                           dont_have_restart, restart_num))
+
+    def order_by_expected_work(self, met_files):
+        """
+        Sort the sites by the number of runs they needed last time, most
+        first. Sites we haven't run before go first as we've no idea.
+        """
+        counts = self.read_spin_counts()
+
+        def expected(fname):
+            site = os.path.basename(fname).split(".")[0].split("_")[0]
+            experiment_id = self.get_experiment_id(site)
+            return counts.get(experiment_id, float("inf"))
+
+        return sorted(met_files, key=expected, reverse=True)
+
+    def read_spin_counts(self):
+
+        if not os.path.isfile(self.spin_counts_fname):
+            return {}
+        with open(self.spin_counts_fname, "r") as f:
+            counts = json.load(f)
+
+        return counts
+
+    def record_spin_counts(self, results):
+        """
+        Remember how many runs each site took, for ordering the next campaign.
+        If the site was resumed that includes the runs made before, which
+        the state file keeps count of.
+        """
+        counts = self.read_spin_counts()
+        for (fname, experiment_id, status, nruns, elapsed) in results:
+            if status != "ok":
+                continue
+            state_fname = self.state_fname(experiment_id)
+            if os.path.isfile(state_fname):
+                with open(state_fname, "r") as f:
+                    nruns = json.load(f).get("cable_runs", nruns)
+            counts[experiment_id] = nruns
+
+        tmp_fname = "%s.%d.tmp" % (self.spin_counts_fname, os.getpid())
+        with open(tmp_fname, "w") as f:
+            json.dump(counts, f, indent=2, sort_keys=True)
+        os.replace(tmp_fname, self.spin_counts_fname)
+
+    def report_status(self, met_files, results):
+
+        print("\n===================================================\n")
+        print("Site status\n")
+        print("===================================================\n\n")
+        done = set()
+        for (fname, experiment_id, status, nruns, elapsed) in results:
+            done.add(fname)
+            print("%s: %s, %d runs, %.1f hours" % \
+                    (experiment_id, status, nruns, elapsed / 3600.))
+        for fname in met_files:
+            if fname not in done:
+                print("%s: never finished" % (os.path.basename(fname)))
+
+        # Campaign summary
+        df = pd.DataFrame(results, columns=["met_fname", "experiment_id",
+                                            "status", "nruns", "elapsed"])
+        df.to_csv(self.summary_fname, index=False)
+
+        print("\n%d ok, %d failed, %d skipped, %d never finished" % \
+                ((df.status == "ok").sum(), (df.status == "failed").sum(),
+                 (df.status == "skipped").sum(), len(set(met_files) - done)))
+        print("%.1f hours of site time, %d CABLE runs" % \
+                (df.elapsed.sum() / 3600., df.nruns.sum()))
+        if (df.status == "failed").any():
+            print("Failures are listed in %s" % (self.failures_fname))
+        print("Summary written to %s" % (self.summary_fname))
+
+    def current_phase(self):
+        """
+        The phase we're working on, i.e. the first one not yet completed
+        """
+        if self.state is None:
+            return ""
+        for phase in self.PHASES:
+            if phase not in self.state["completed"]:
+                return phase
+        return ""
+
+    def record_failure(self, exit_code, message, attempt=""):
+        """
+        Add a row to the failures ledger. Shared by all the workers, hence
+        the lock.
+        """
+        row = [dt.datetime.now().isoformat(timespec="seconds"),
+               self.experiment_id, self.current_phase(), self.run_tag,
+               self.run_number, attempt, exit_code, message]
+        row = ["" if v is None else str(v).replace(",", ";") for v in row]
+
+        with FileLock("%s.lock" % (self.failures_fname)):
+            new_file = not os.path.isfile(self.failures_fname)
+            with open(self.failures_fname, "a") as f:
+                if new_file:
+                    f.write("time,experiment_id,phase,run,iteration,attempt,"
+                            "exit_code,message\n")
+                f.write(",".join(row) + "\n")
+
+    def start_met_prefetch(self, met_files):
+        """
+        Prepare the met files for the sites in the background, in the order
+        the workers will need them. While site N is spinning up, the files
+        for site N+1 are being made. Workers wait on (or reuse) anything the
+        prefetch has started, via the met cache.
+        """
+        if self.met_prefetch_workers < 1:
+            return None
+
+        # Failures here aren't fatal, the worker will just try to make the
+        # files itself and report any problem
+        met_pool = mp.Pool(processes=self.met_prefetch_workers)
+        met_pool.map_async(self.prepare_met_files, met_files, chunksize=1)
+        met_pool.close()
+
+        return met_pool
+
+    def prepare_met_files(self, fname):
+
+        site = os.path.basename(fname).split(".")[0].split("_")[0]
+        self.generate_met_files(site, None, None, fname)
+
+    def worker(self, met_files, url, rev, sci_config, dont_have_restart,
+               restart_num):
+
+        results = []
+        for fname in met_files:
+            results.append(self.run_site(fname, url, rev, sci_config,
+                                         dont_have_restart, restart_num))
+
+        return results
+
+    def run_site(self, fname, url, rev, sci_config, dont_have_restart,
+                 restart_num):
+        """
+        Spin up and run a single site. Returns the site's status, so a
+        failure at one site doesn't stop the others.
+        """
+        start = time.time()
+        site = os.path.basename(fname).split(".")[0].split("_")[0]
+        experiment_id = self.get_experiment_id(site)
+        self.experiment_id = experiment_id
+        self.state = None
+        self.run_tag = None
+        self.run_number = None
+        self.speculative_num = None
+        self.work_dir = None
+        self.cable_runs = 0 # every time CABLE is started, see run_me
+        try:
+            if self.speculative_branch:
+                # held while we run, see publish_restart
+                with FileLock(self.running_fname(experiment_id)):
+                    self.spin_site(fname, url, rev, sci_config,
+                                   dont_have_restart, restart_num)
+            else:
+                self.spin_site(fname, url, rev, sci_config, dont_have_restart,
+                               restart_num)
+            status = "ok"
+        except SpinAborted as e:
+            print("%s" % (e))
+            status = "aborted"
+        except CableRunError:
+            # already in the failures ledger
+            traceback.print_exc()
+            status = "failed"
+        except Exception as e:
+            traceback.print_exc()
+            self.record_failure("", "%s: %s" % (type(e).__name__, e))
+            status = "failed"
+
+        if self.speculative_branch:
+            # An abandoned branch will be started again in a new work dir,
+            # see restart_speculative
+            if status == "aborted" and self.work_dir is not None:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+            self.remove_running_lock(experiment_id)
+
+        # The restart numbers carry on from an earlier cycle or a resumed
+        # run, so can't tell us how many runs this site took
+        return (fname, experiment_id, status, self.cable_runs,
+                time.time() - start)
+
+    def spin_site(self, fname, url, rev, sci_config, dont_have_restart,
+                  restart_num):
+        """
+        Spin up and run a site, returning the last restart number. Up to
+        each runner.
+        """
+        raise NotImplementedError
+
+    def run_spin(self, num, phase, labile=True):
+        """
+        Another spin from the last restart, then record where we got to
+        """
+        self.check_abort()
+        self.setup_spin(number=num, labile=labile)
+        self.spin_control.count_run()
+        self.run_me()
+        self.clean_up(num, tag="spin")
+        # it will have left CASA dumps for an analytical spin to read
+        self.have_dumps = True
+        self.record_run(num, "spin", phase)
+        self.save_state(phase, num)
+
+    def accelerate_spin(self, num, phase, labile=True, **check):
+        """
+        Extrapolate the CASA pools from the last three spins (restarts
+        num-3 to num-1) towards steady state, then do one confirmation spin
+        from the extrapolated restart and check it. Only done if none of
+        those spins started from an earlier extrapolation.
+
+        Returns the next run number and whether we're still not stable.
+        """
+        last = num - 1
+        if last - 2 <= self.last_extrapolated:
+            return (num, True)
+
+        if not extrapolate_casa_restart(self.experiment_id, self.restart_dir,
+                                        last, debug=self.verbose):
+            return (num, True)
+        self.last_extrapolated = last
+
+        print("\n===================================================\n")
+        print("Extrapolated pools from restart %d, confirming: %d\n" % \
+                (last, num))
+        print("===================================================\n\n")
+        self.run_spin(num, phase, labile=labile)
+        not_stabilised = self.check_spin(num, extrapolated=True, **check)
+
+        return (num + 1, not_stabilised)
+
+    def check_spin(self, num, extrapolated=False, **check):
+        """
+        Steady-state check of restart num against the one before, using the
+        phase's tolerance. The spin controller is told how far off we are,
+        unless the spin started from extrapolated pools.
+        """
+        (not_stabilised,
+         delta, tol) = check_steady_state(self.experiment_id,
+                                          self.restart_dir, self.output_dir,
+                                          num, debug=True,
+                                          tol=self.spin_control.tol,
+                                          return_delta=True, **check)
+        if extrapolated:
+            self.spin_control.record_extrapolated(not not_stabilised)
+        else:
+            self.spin_control.record(not not_stabilised, delta, tol)
+        self.ledger.append(experiment_id=self.experiment_id, site=self.site,
+                           cycle=self.biogeochem_cyc,
+                           phase=self.spin_control.phase, iteration=num,
+                           event="check", delta=delta, tol=tol,
+                           converged=not not_stabilised,
+                           **self.ledger_pools(num))
+
+        # Near enough for the next cycle to make a start
+        if (not_stabilised and self.speculate is not None and
+            self.spin_control.phase == "unrestricted_labile" and
+            delta < self.speculate * tol):
+            self.speculate_restart(tol)
+
+        return not_stabilised
+
+    def record_run(self, num, event, phase):
+        """
+        Add the state at the end of a spin run (restart num) to the ledger
+        """
+        casa_tag = "spin_analytic" if event == "aspin" else "spin"
+        casa_fname = "%s_out_casa_%s_%d.nc" % (self.experiment_id, casa_tag,
+                                               num)
+        cable_fname = "%s_out_cable_%s_%d.nc" % (self.experiment_id, event,
+                                                 num)
+        diag = read_run_diagnostics(os.path.join(self.output_dir, casa_fname),
+                                    os.path.join(self.output_dir, cable_fname))
+
+        runtime = None
+        if self.last_run is not None:
+            runtime = self.last_run.runtime
+
+        self.ledger.append(experiment_id=self.experiment_id, site=self.site,
+                           cycle=self.biogeochem_cyc, phase=phase,
+                           iteration=num, event=event, runtime=runtime,
+                           **self.ledger_pools(num), **diag)
+
+    def ledger_pools(self, num):
+        """
+        The CASA C pools in restart num, as ledger columns
+        """
+        casa_rst_fname = "%s_casa_rst_%d.nc" % (self.experiment_id, num)
+        casa_rst_fname = os.path.join(self.restart_dir, casa_rst_fname)
+        pools = {}
+        if os.path.isfile(casa_rst_fname):
+            pools = get_casa_pools(casa_rst_fname)
+
+        return {"cf": pools.get("cl"), "cw": pools.get("cw"),
+                "cr": pools.get("cr"), "ca": pools.get("active"),
+                "cs": pools.get("slow"), "cp": pools.get("passive")}
+
+    def read_state(self):
+        """
+        Where the site's spin-up got to. Unless we're resuming we start
+        from scratch.
+        """
+        state = {"experiment_id": self.experiment_id, "phase": None,
+                 "restart_num": None, "restart_files": [], "completed": [],
+                 "cable_runs": 0}
+        if self.resume and os.path.isfile(self.state_fname()):
+            with open(self.state_fname(), "r") as f:
+                state = json.load(f)
+
+        # runs made by the jobs before this one
+        self.earlier_runs = state.get("cable_runs", 0)
+
+        return state
+
+    def save_state(self, phase, restart_num):
+        """
+        Record the phase we're in and the restart pair the next run should
+        start from, after every run, so a job that dies can resume from here
+        """
+        cable_rst = "%s_cable_rst_%d.nc" % (self.experiment_id, restart_num)
+        casa_rst = "%s_casa_rst_%d.nc" % (self.experiment_id, restart_num)
+
+        self.state["phase"] = phase
+        self.state["restart_num"] = restart_num
+        self.state["restart_files"] = [os.path.join(self.restart_dir, cable_rst),
+                                       os.path.join(self.restart_dir, casa_rst)]
+        self.write_state()
+
+    def end_phase(self, phase):
+        if phase not in self.state["completed"]:
+            self.state["completed"].append(phase)
+            self.write_state()
+
+    def phase_done(self, phase):
+        return phase in self.state["completed"]
+
+    def state_fname(self, experiment_id=None):
+        if experiment_id is None:
+            experiment_id = self.experiment_id
+        return os.path.join(self.restart_dir,
+                            "%s_state.json" % (experiment_id))
+
+    def write_state(self):
+
+        self.state["cable_runs"] = self.earlier_runs + self.cable_runs
+        fname = self.state_fname()
+        tmp_fname = "%s.%d.tmp" % (fname, os.getpid())
+        with open(tmp_fname, "w") as f:
+            json.dump(self.state, f, indent=2)
+        os.replace(tmp_fname, fname)
+
+    def setup_work_dir(self):
+        """
+        Each site (and cycle) runs in its own dir in the scratch space,
+        holding the namelist, a link to the executable and whatever CABLE
+        writes to the cwd (CASA outputs, dumps, ...). Left in place if the
+        site fails, so you can see what happened.
+        """
+        self.work_dir = tempfile.mkdtemp(prefix="%s_" % (self.experiment_id),
+                                         dir=self.scratch_dir)
+        os.symlink(self.cable_exe, os.path.join(self.work_dir,
+                                                os.path.basename(self.cable_exe)))
+
+    def setup_nml_file(self, site):
+        # get a clean namelist file
+
+        # The base namelist is only read once per process, each site then
+        # works on its own in-memory copy which is written out in a single
+        # go whenever a phase changes it
+        base_nml_fn = os.path.join(self.grid_dir, "%s" % (self.base_nml_fname))
+        self.nml = Namelist.load(base_nml_fn).copy()
+        if not self.nml_template:
+            nml_fname = os.path.join(self.work_dir, "cable_%s.nml" % (site))
+            self.nml.write(nml_fname)
+            self.nml_fname = nml_fname
+
+    def write_nml(self, replace_dict, tag, number=None):
+        """
+        Apply this run's changes to the site's namelist and write out the
+        namelist CABLE will run with.
+
+        In template mode each run (spin N, aspin N, historical, simulation)
+        gets its own namelist in the namelist dir, holding the base namelist
+        plus every change made for the site up to that run. Nothing is read
+        back or edited in place and any run can be re-executed from its
+        namelist.
+        """
+        self.nml.update(replace_dict)
+        self.run_tag = tag
+        self.run_number = number
+        if self.nml_template:
+            if number is None:
+                fname = "%s_%s.nml" % (self.experiment_id, tag)
+            else:
+                fname = "%s_%s_%d.nml" % (self.experiment_id, tag, number)
+            self.nml_fname = os.path.join(self.namelist_dir, fname)
+        self.nml.write(self.nml_fname)
+
+    def generate_met_files(self, site, st_yr, en_yr, met_fname):
+
+        co2_ndep_fname = "AmaFACE_co2npdepforcing_1850_2100_%s.csv" % \
+                            (self.forcing)
+        co2_ndep_fname = os.path.join(self.co2_ndep_dir, co2_ndep_fname)
+
+        # Derived met files are cached on their inputs, so they are only
+        # regenerated if the met file, forcing csv or fixed CO2/Ndep/Pdep
+        # change
+        M = MetFileCache(self.met_cache_dir, nc_options=self.met_nc_options)
+        (fname_spin,
+         fname_trans,
+         fname_sim) = M.get_met_files(site, met_fname, co2_ndep_fname,
+                                      self.co2_fixed, self.ndep_fixed,
+                                      self.pdep_fixed,
+                                      virtual_transient=self.virtual_transient)
+
+        return (fname_spin, fname_trans, fname_sim)
+
+    def materialise_transient(self, fname_trans):
+        """
+        Write out the transient met file described by fname_trans to the
+        scratch dir, so CABLE can read it
+        """
+        ofname = "%s_met_trans.nc" % (self.experiment_id)
+        ofname = os.path.join(self.scratch_dir, ofname)
+
+        T = TransientMet(fname_trans, nc_options=self.met_nc_options)
+        T.materialise(ofname)
+        T.close()
+
+        return ofname
+
+    def setup_inital_restart_file(self, number, site):
+
+        if self.biogeochem_cyc == "CN":
+            old_experiment_id = self.get_experiment_id(site, "C")
+        elif self.biogeochem_cyc == "CNP":
+            old_experiment_id = self.get_experiment_id(site, "CN")
+
+        cable_rst_ofname = "%s_cable_rst_%d.nc" % (old_experiment_id, number)
+        cable_rst_ofname = os.path.join(self.restart_dir, cable_rst_ofname)
+        new_cable_rst = "%s_cable_rst_%d.nc" % (self.experiment_id, number)
+        new_cable_rst = os.path.join(self.restart_dir, new_cable_rst)
+        shutil.copy(cable_rst_ofname, new_cable_rst)
+
+        casa_rst_ofname = "%s_casa_rst_%d.nc" % (old_experiment_id, number)
+        casa_rst_ofname = os.path.join(self.restart_dir, casa_rst_ofname)
+        new_casa_rst = "%s_casa_rst_%d.nc" % (self.experiment_id, number)
+        new_casa_rst = os.path.join(self.restart_dir, new_casa_rst)
+        shutil.copy(casa_rst_ofname, new_casa_rst)
+
+    def initialise_stuff(self):
+
+        if not os.path.exists(self.restart_dir):
+            os.makedirs(self.restart_dir)
+
+        if not os.path.exists(self.output_dir):
+            os.makedirs(self.output_dir)
+
+        if not os.path.exists(self.log_dir):
+            os.makedirs(self.log_dir)
+
+        if not os.path.exists(self.namelist_dir):
+            os.makedirs(self.namelist_dir)
+
+        if not os.path.exists(self.dump_dir):
+            os.makedirs(self.dump_dir)
+
+        # CABLE runs in a separate working dir for each site (see
+        # setup_work_dir), so anything it is pointed at needs a full path
+        self.met_dir = os.path.abspath(self.met_dir)
+        self.log_dir = os.path.abspath(self.log_dir)
+        self.output_dir = os.path.abspath(self.output_dir)
+        self.restart_dir = os.path.abspath(self.restart_dir)
+        self.namelist_dir = os.path.abspath(self.namelist_dir)
+        self.dump_dir = os.path.abspath(self.dump_dir)
+        self.met_cache_dir = os.path.abspath(self.met_cache_dir)
+        self.scratch_dir = os.path.abspath(self.scratch_dir)
+        self.veg_fname = os.path.abspath(self.veg_fname)
+        self.soil_fname = os.path.abspath(self.soil_fname)
+        self.grid_fname = os.path.abspath(self.grid_fname)
+        self.phen_fname = os.path.abspath(self.phen_fname)
+        self.cnpbiome_fname = os.path.abspath(self.cnpbiome_fname)
+
+        # Run all the met files in the directory
+        if len(self.met_subset) == 0:
+            met_files = glob.glob(os.path.join(self.met_dir, "*.nc"))
+        else:
+            met_files = [os.path.join(self.met_dir, i) for i in self.met_subset]
+
+        cwd = os.getcwd()
+        (url, rev) = get_svn_info(cwd, self.cable_src)
+
+        # delete local executable, copy a local copy and use that
+        local_exe = "cable"
+        if os.path.isfile(local_exe):
+            os.remove(local_exe)
+        shutil.copy(self.cable_exe, local_exe)
+        self.cable_exe = os.path.abspath(local_exe)
+
+        return (met_files, url, rev)
+
+    def clean_up(self, number, tag):
+
+        # CASA out file is hardwired!
+        fname = glob.glob(os.path.join(self.work_dir, "*_casa_out.nc"))
+        if len(fname) > 0:
+            if number is None:
+                out_fname = "%s_out_casa_%s.nc" % \
+                                    (self.experiment_id, tag)
+            else:
+                out_fname = "%s_out_casa_%s_%d.nc" % \
+                                    (self.experiment_id, tag, number)
+            move_file(fname[0], os.path.join(self.output_dir, out_fname))
+
+        f = os.path.join(self.work_dir, "cnpfluxOut.csv")
+        if os.path.isfile(f):
+            os.remove(f)
+
+        f = os.path.join(self.work_dir, "new_sumbal")
+        if os.path.isfile(f):
+            os.remove(f)
+
+        if tag == "simulation":
+            for f in glob.glob(os.path.join(self.work_dir, "c2c_*_dump.nc")):
+                move_file(f, os.path.join(self.dump_dir, os.path.basename(f)))
+
+    def run_me(self):
+        # run the model
+        exe = "./%s" % (os.path.basename(self.cable_exe))
+
+        # CABLE's screen output for this run, named after its output file
+        out_fname = os.path.basename(self.nml.get("filename%out").strip("' "))
+        log_fname = "%s_stdout.txt" % (os.path.splitext(out_fname)[0])
+        log_fname = os.path.join(self.log_dir, log_fname)
+
+        if self.verbose:
+            print("%s %s" % (exe, self.nml_fname))
+        timeout = self.run_timeouts.get(self.run_tag)
+
+        # A failed run is tried again with the same namelist, i.e. from the
+        # same restart, keeping the log of each failed attempt
+        attempt = 0
+        while True:
+            self.cable_runs += 1
+            result = self.executor.run(exe, self.nml_fname, cwd=self.work_dir,
+                                       log_fname=log_fname, timeout=timeout)
+            self.last_run = result
+            if self.verbose:
+                print(result)
+            if result.ok:
+                break
+
+            attempt += 1
+            print("Job failed: %s, see %s" % (result, log_fname))
+            self.record_failure(result.returncode, str(result), attempt)
+            failed_log_fname = "%s.failed_%d" % (log_fname, attempt)
+            os.replace(log_fname, failed_log_fname)
+            if attempt > self.max_retries:
+                raise CableRunError(str(result))
+            print("Retrying (%d of %d)" % (attempt, self.max_retries))
+
+    def get_met_years(self, met_fname):
+        import xarray as xr # only needed here, slow to import
+
+        ds = xr.open_dataset(met_fname)
+        st_yr = pd.to_datetime(ds.time[0].values).year
+        en_yr = pd.to_datetime(ds.time[-1].values).year #- 1
+
+        return (st_yr, en_yr)
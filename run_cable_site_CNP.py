@@ -35,9 +35,17 @@ To spin the model up to equilibrium there are 4 steps:
 If you've already run the C version, you can speed things up by using the
 restart file from this as the initial condition for the CN run. You can of course
 do likewise for a CNP run, using the CN restart file. You simply need to set
-"dont_have_restart" to be False and supply the restart file number.
+"dont_have_restart" to be False and supply the restart file number. Or use
+RunCable.pipeline, which does this for you, starting each site's CN spin as
+soon as its C spin has converged (and likewise for CNP).
 
-NB. Set mpi = True if doing a number of flux sites (*needs checking...)
+The machinery shared with the other runner (running CABLE, resuming,
+scheduling sites, the pipeline and reporting) is in run_cable_base.py, this
+script just has the spin-up itself.
+
+NB. Set mpi = True if doing a number of flux sites. Each site is run in its
+own working directory under the scratch dir, so sites don't trample on each
+other's CASA outputs.
 
 ps. my suggestion is that you use this script as an experimental record, so
 embed flags you want either directly into the "replace_dict" dict...or better
@@ -52,139 +60,63 @@ __version__ = "1.0 (05.02.2020)"
 __email__ = "mdekauwe@gmail.com"
 
 import os
-import sys
-import glob
 import shutil
-import subprocess
-import multiprocessing as mp
-import numpy as np
-import xarray as xr
-import pandas as pd
-
-from cable_utils import adjust_nml_file
-from cable_utils import get_svn_info
-from cable_utils import change_LAI
-from cable_utils import add_attributes_to_output_file
-from cable_utils import check_steady_state
-from generate_cable_met_files import GenerateMetFiles
-
-
-class RunCable(object):
-
-    def __init__(self, met_dir=None, log_dir=None, output_dir=None,
-                 restart_dir=None, aux_dir=None, namelist_dir=None,
-                 nml_fname="cable.nml", dump_dir=None,
-                 veg_fname="def_veg_params_zr_clitt_albedo_fix.txt",
-                 soil_fname="def_soil_params.txt",
-                 grid_fname="gridinfo_CSIRO_1x1.nc",
-                 phen_fname="modis_phenology_csiro.txt",
-                 #cnpbiome_fname="pftlookup_csiro_v16_17tiles_Ticket2.csv",
-                 cnpbiome_fname="pftlookup_csiro_v16_17tiles-cheng-m02.csv",
-                 elev_fname="GSWP3_gwmodel_parameters.nc",
-                 biogeochem="C", co2_ndep_dir=None,
-                 lai_dir=None, fixed_lai=None, co2_conc=400.0, co2_fixed=284.7,
-                 ndep_fixed=0.79, pdep_fixed=0.144,met_subset=[],
-                 cable_src=None, cable_exe="cable", mpi=True,
-                 num_cores=None, verbose=True):
-
-        self.met_dir = met_dir
-        self.dump_dir = dump_dir
-        self.log_dir = log_dir
-        self.output_dir = output_dir
-        self.restart_dir = restart_dir
-        self.aux_dir = aux_dir
-        self.namelist_dir = namelist_dir
-        self.co2_ndep_dir = co2_ndep_dir
-        self.nml_fname = nml_fname
-        self.biogeophys_dir = os.path.join(self.aux_dir, "core/biogeophys")
-        self.grid_dir = os.path.join(self.aux_dir, "offline")
-        self.biogeochem_dir = os.path.join(self.aux_dir, "core/biogeochem/")
-        self.veg_fname = os.path.join(self.biogeophys_dir, veg_fname)
-        self.soil_fname = os.path.join(self.biogeophys_dir, soil_fname)
-        self.grid_fname = os.path.join(self.grid_dir, grid_fname)
-        self.phen_fname = os.path.join(self.biogeochem_dir, phen_fname)
-        #self.cnpbiome_fname = os.path.join(self.biogeochem_dir, cnpbiome_fname)
-        self.cnpbiome_fname = os.path.join("CNP_param_file", cnpbiome_fname)
-        self.elev_fname = elev_fname
-        self.co2_conc = co2_conc
-        self.met_subset = met_subset
-        self.cable_src = cable_src
-        self.cable_exe = os.path.join(cable_src, "offline/%s" % (cable_exe))
-        self.verbose = verbose
-        self.mpi = mpi
-        self.num_cores = num_cores
-        self.lai_dir = lai_dir
-        self.fixed_lai = fixed_lai
-        self.biogeochem_cyc = biogeochem
-        self.co2_fixed = co2_fixed    # umol mol-1
-        self.ndep_fixed = ndep_fixed  # kg N ha-1 yr-1
-        self.pdep_fixed = pdep_fixed  # kg N ha-1 yr-1
-
-        if self.biogeochem_cyc == "C":
-            self.biogeochem_id = 1
-            self.vcmax_feedback = ".FALSE."
-        elif self.biogeochem_cyc == "CN":
-            self.biogeochem_id = 2
-            self.vcmax_feedback = ".TRUE."
-        elif self.biogeochem_cyc == "CNP":
-            self.biogeochem_id = 3
-            self.vcmax_feedback = ".TRUE."
-
-    def main(self, sci_config, dont_have_restart=True, restart_num=None):
-
-        (met_files, url, rev) = self.initialise_stuff()
-
-        # Setup multi-processor jobs
-        if self.mpi:
-            if self.num_cores is None: # use them all!
-                self.num_cores = mp.cpu_count()
-            chunk_size = int(np.ceil(len(met_files) / float(self.num_cores)))
-            pool = mp.Pool(processes=self.num_cores)
-            processes = []
-
-            for i in range(self.num_cores):
-                start = chunk_size * i
-                end = chunk_size * (i + 1)
-                if end > len(met_files):
-                    end = len(met_files)
-
-                # setup a list of processes that we want to run
-                p = mp.Process(target=self.worker,
-                               args=(met_files[start:end], url, rev,
-                                     sci_config, dont_have_restart,
-                                     restart_num, ))
-                processes.append(p)
-
-            # Run processes
-            for p in processes:
-                p.start()
-        else:
-            self.worker(met_files, url, rev, sci_config, dont_have_restart,
-                        restart_num,)
 
-    def worker(self, met_files, url, rev, sci_config, dont_have_restart,
-               restart_num):
-
-        num = 0
+from cable_utils import add_attributes_to_output_file
+from cable_utils import move_file
+from run_cable_base import RunCableBase
 
-        for fname in met_files:
 
-            site = os.path.basename(fname).split(".")[0].split("_")[0]
-            self.experiment_id = "%s_%s" % (site, self.biogeochem_cyc)
-            print("\n%s\n" % (site))
+class RunCable(RunCableBase):
 
-            (st_yr, en_yr) = self.get_met_years(fname)
+    # The steps each site goes through, in order, see spin_site
+    PHASES = ["initial", "npp", "soil_analytic", "unrestricted_labile",
+              "historical", "simulation"]
 
-            (fname_spin,
-             fname_trans,
-             fname_sim) = self.generate_met_files(site, st_yr, en_yr, fname)
+    def spin_site(self, fname, url, rev, sci_config, dont_have_restart,
+                  restart_num):
 
-            self.setup_nml_file(site)
-            self.inital_spin_setup(site, fname_spin, sci_config, num)
+        num = 0
 
-            # First phase: spin up with static CO2, Ndep, Pdep. Here we run the
-            # model once to read in the initial plant and soil C pools from the
-            # PFT level file and setup the restart file.
+        site = os.path.basename(fname).split(".")[0].split("_")[0]
+        self.experiment_id = self.get_experiment_id(site)
+        self.site = site
+        self.site_fname = fname
+        print("\n%s\n" % (site))
+
+        (st_yr, en_yr) = self.get_met_years(fname)
+
+        (fname_spin,
+         fname_trans,
+         fname_sim) = self.generate_met_files(site, st_yr, en_yr, fname)
+
+        self.setup_work_dir()
+        self.setup_nml_file(site)
+        self.inital_spin_setup(site, fname_spin, sci_config, num)
+
+        # The analytical spin reads the CASA dumps the previous spin left in
+        # the working dir
+        self.have_dumps = False
+
+        # Pick up from the last run a previous attempt at this site finished
+        self.state = self.read_state()
+        self.last_extrapolated = -1
+        self.spin_control.reset()
+        if self.spun_up_from is not None and self.state["restart_num"] is None:
+            # Another forcing has done the spin-up for us, see
+            # publish_restart
+            i = self.PHASES.index("historical")
+            self.state["completed"] = self.PHASES[:i]
+            self.state["restart_num"] = self.spun_up_from
+        if self.state["restart_num"] is not None:
+            num = self.state["restart_num"] + 1
+            print("Resuming %s from restart %d" % \
+                    (self.experiment_id, self.state["restart_num"]))
+
+        # First phase: spin up with static CO2, Ndep, Pdep. Here we run the
+        # model once to read in the initial plant and soil C pools from the
+        # PFT level file and setup the restart file.
+        if not self.phase_done("initial"):
             if dont_have_restart:
 
                 # Create initial restart file
@@ -193,132 +125,150 @@ class RunCable(object):
                 print("===============================================\n\n")
                 self.run_me()
                 self.clean_up(num, tag="spin")
+                self.record_run(num, "spin", "initial")
+                self.have_dumps = True
+                self.save_state("initial", num)
                 num += 1
             else:
-                self.setup_inital_restart_file(restart_num-1, site)
+                # In pipeline mode the previous cycle has already copied
+                # its restart over for us (see publish_restart)
+                if not self.restart_published:
+                    self.setup_inital_restart_file(restart_num-1, site)
 
                 # We need to generate a "previous" run for the stability check
-                self.setup_spin(number=restart_num)
-                self.run_me()
-                self.clean_up(restart_num, tag="spin")
-                
+                self.run_spin(restart_num, "initial")
+
                 # logic is based on that final increment above that the user
                 # won't do...
                 num = restart_num + 1
+            self.end_phase("initial")
 
+        #"""
+        # Second phase: find steady-state NPP
+        not_stabilised = not self.phase_done("npp")
+        self.spin_control.start_phase("npp", batch=1)
+        while not_stabilised:
 
+            print("\n===============================================\n")
+            print("Find steady-state NPP: %d\n" % (num))
+            print("===============================================\n\n")
+            for i in range(self.spin_control.next_batch()):
+                self.run_spin(num, "npp")
 
-            #"""
-            # Second phase: find steady-state NPP
-            not_stabilised = True
-            while not_stabilised:
+                num += 1
 
-                print("\n===============================================\n")
-                print("Find steady-state NPP: %d\n" % (num))
-                print("===============================================\n\n")
-                self.setup_spin(number=num)
-                self.run_me()
-                self.clean_up(num, tag="spin")
+            not_stabilised = self.check_spin(num-1, check_npp=True)
 
-                not_stabilised = check_steady_state(self.experiment_id,
-                                                    self.restart_dir,
-                                                    self.output_dir,
-                                                    num, check_npp=True,
-                                                    debug=True)
-                num += 1
+            if not_stabilised and self.accelerate:
+                (num, not_stabilised) = self.accelerate_spin(num, "npp",
+                                                             check_npp=True)
+        self.end_phase("npp")
+
+        """
+        # Third phase: bring plant biomass pools into equilibrium
+        not_stabilised = True
+        while not_stabilised:
+
+            print("\n===============================================\n")
+            print("Bring plant C pools into equilibrium: %d\n" % (num))
+            print("===============================================\n\n")
+            self.setup_spin(number=num)
+            self.run_me()
+            self.clean_up(num, tag="spin")
+
+            not_stabilised = check_steady_state(self.experiment_id,
+                                                self.restart_dir,
+                                                self.output_dir,
+                                                num, check_plant=True,
+                                                debug=True)
+            num += 1
+        """
 
-            """
-            # Third phase: bring plant biomass pools into equilibrium
-            not_stabilised = True
-            while not_stabilised:
+        #"""
+        # Fourht phase: bring soil pools into equilibrium using analytical
+        # solution
+        not_stabilised = not self.phase_done("soil_analytic")
+        self.spin_control.start_phase("soil_analytic", batch=3)
+        while not_stabilised:
 
-                print("\n===============================================\n")
-                print("Bring plant C pools into equilibrium: %d\n" % (num))
-                print("===============================================\n\n")
-                self.setup_spin(number=num)
-                self.run_me()
-                self.clean_up(num, tag="spin")
+            print("\n===================================================\n")
+            print("Bring soil C pools into equilibrium: %d\n" % (num))
+            print("===================================================\n\n")
+            num = self.run_analytical_spin(st_yr, en_yr, num, "soil_analytic")
 
-                not_stabilised = check_steady_state(self.experiment_id,
-                                                    self.restart_dir,
-                                                    self.output_dir,
-                                                    num, check_plant=True,
-                                                    debug=True)
-                num += 1
-            """
-
-            #"""
-            # Fourht phase: bring soil pools into equilibrium using analytical
-            # solution
-            not_stabilised = True
-            while not_stabilised:
-
-                print("\n===================================================\n")
-                print("Bring soil C pools into equilibrium: %d\n" % (num))
-                print("===================================================\n\n")
-                self.setup_analytical_spin(st_yr, en_yr, number=num)
-                self.run_me()
-                self.clean_up(num, tag="spin_analytic")
+            not_stabilised = self.check_spin(num, check_soil=True)
 
-                not_stabilised = check_steady_state(self.experiment_id,
-                                                    self.restart_dir,
-                                                    self.output_dir,
-                                                    num, check_soil=True,
-                                                    debug=True)
+            # Not found a steady-state solution run further simulations...
+            for i in range(self.spin_control.next_batch()):
+                self.run_spin(num, "soil_analytic")
 
-                # Not found a steady-state solution run further simulations...
-                for i in range(3):
-                    self.setup_spin(number=num)
-                    self.run_me()
-                    self.clean_up(num, tag="spin")
+                num += 1
 
-                    num += 1
+            if not_stabilised and self.accelerate:
+                (num, not_stabilised) = self.accelerate_spin(num,
+                                                             "soil_analytic",
+                                                             check_soil=True)
+        self.end_phase("soil_analytic")
 
-            # Fourth phase: bring soil pools into equilibrium using analytical
-            # solution, but without restricting N and P pools
-            for i in range(3):
+        # Fourth phase: bring soil pools into equilibrium using analytical
+        # solution, but without restricting N and P pools. Three spins to
+        # free up the labile pools first, counted in the state file so a
+        # resumed job only runs the ones it hadn't finished.
+        if not self.phase_done("unrestricted_labile"):
+            for i in range(self.state.get("warmup_spins", 0), 3):
 
                 # run another simulation...
-                self.setup_spin(number=num, labile=False)
-                self.run_me()
-                self.clean_up(num, tag="spin")
+                self.run_spin(num, "unrestricted_labile", labile=False)
+                self.state["warmup_spins"] = i + 1
+                self.write_state()
 
                 num += 1
 
-            not_stabilised = True
-            while not_stabilised:
+        not_stabilised = not self.phase_done("unrestricted_labile")
+        self.spin_control.start_phase("unrestricted_labile", batch=5)
+        while not_stabilised:
 
-                print("\n===================================================\n")
-                print("Bring soil C pools into equilibrium: \n")
-                print("Urestricted labile P/mineral N: %d\n" % (num))
-                print("===================================================\n\n")
-                self.setup_analytical_spin(st_yr, en_yr, number=num)
-                self.run_me()
-                self.clean_up(num, tag="spin_analytic")
+            print("\n===================================================\n")
+            print("Bring soil C pools into equilibrium: \n")
+            print("Urestricted labile P/mineral N: %d\n" % (num))
+            print("===================================================\n\n")
+            num = self.run_analytical_spin(st_yr, en_yr, num,
+                                           "unrestricted_labile")
+
+            not_stabilised = self.check_spin(num, check_soil=True)
 
-                not_stabilised = check_steady_state(self.experiment_id,
-                                                    self.restart_dir,
-                                                    self.output_dir,
-                                                    num, check_soil=True,
-                                                    debug=True)
+            # Not found a steady-state solution run further simulations...
+            for i in range(self.spin_control.next_batch()):
+                self.run_spin(num, "unrestricted_labile")
+
+                num += 1
 
-                # Not found a steady-state solution run further simulations...
-                for i in range(5):
-                    self.setup_spin(number=num)
-                    self.run_me()
-                    self.clean_up(num, tag="spin")
+            if not_stabilised and self.accelerate:
+                (num, not_stabilised) = self.accelerate_spin(num,
+                                                             "unrestricted_labile",
+                                                             check_soil=True)
+        self.end_phase("unrestricted_labile")
 
-                    num += 1
+        # Spun up, the next cycle can start from here
+        self.publish_restart(fname, site, num-1)
 
-            # Run transient simulation from 1850
+        # Run transient simulation from 1850
+        if not self.phase_done("historical"):
             print("\n===================================================\n")
             print("Historical\n")
             print("===================================================\n\n")
+            if self.virtual_transient:
+                fname_trans = self.materialise_transient(fname_trans)
             (out_fname) = self.setup_simulation(fname_trans, historical=True,
                                                 number=num-1)
             self.run_me()
             self.clean_up(number=None, tag="historical")
+            if self.virtual_transient:
+                os.remove(fname_trans)
+            self.save_state("historical", num-1)
+            self.end_phase("historical")
 
+        if not self.phase_done("simulation"):
             print("\n===================================================\n")
             print("Simulation\n")
             print("===================================================\n\n")
@@ -328,97 +278,36 @@ class RunCable(object):
             self.clean_up(number=None, tag="simulation")
 
             add_attributes_to_output_file(self.nml_fname, out_fname, url, rev)
-            ofname = os.path.join(self.namelist_dir, self.nml_fname)
-            shutil.move(self.nml_fname, ofname)
+            if not self.nml_template:
+                ofname = os.path.join(self.namelist_dir,
+                                      os.path.basename(self.nml_fname))
+                move_file(self.nml_fname, ofname)
+            self.save_state("simulation", num-1)
+            self.end_phase("simulation")
 
-    def setup_nml_file(self, site):
-        # get a clean namelist file
+        shutil.rmtree(self.work_dir)
 
-        base_nml_fn = os.path.join(self.grid_dir, "%s" % (self.nml_fname))
-        nml_fname = "cable_%s.nml" % (site)
-        shutil.copy(base_nml_fn, nml_fname)
-        self.nml_fname = nml_fname
+        return num
 
-    def generate_met_files(self, site, st_yr, en_yr, met_fname):
-
-        local_met_dir = "met"
-        if not os.path.exists(local_met_dir):
-            os.makedirs(local_met_dir)
-
-        co2_ndep_fname = "AmaFACE_co2npdepforcing_1850_2100_AMB.csv"
-        co2_ndep_fname = os.path.join(self.co2_ndep_dir, co2_ndep_fname)
-
-        G = GenerateMetFiles(site, met_fname, co2_ndep_fname)
-
-        fname_spin = os.path.join(local_met_dir, "%s_met_spin.nc" % (site))
-        if not os.path.isfile(fname_spin):
-            G.create_spin_file(fname_spin, self.co2_fixed, self.ndep_fixed,
-                               self.pdep_fixed)
-
-        fname_trans = os.path.join(local_met_dir, "%s_met_trans.nc" % (site))
-        if not os.path.isfile(fname_trans):
-            G.create_transient_file(fname_trans)
-
-        fname_sim = "%s_met_simulation.nc" % (site)
-        fname_sim = os.path.join(local_met_dir, fname_sim)
-        if not os.path.isfile(fname_sim):
-            G.create_simulation_file(fname_sim)
-
-        return (fname_spin, fname_trans, fname_sim)
-
-    def setup_inital_restart_file(self, number, site):
-
-        if self.biogeochem_cyc == "CN":
-            old_experiment_id = "%s_%s" % (site, "C")
-        elif self.biogeochem_cyc == "CNP":
-            old_experiment_id = "%s_%s" % (site, "CN")
-
-        cable_rst_ofname = "%s_cable_rst_%d.nc" % (old_experiment_id, number)
-        cable_rst_ofname = os.path.join(self.restart_dir, cable_rst_ofname)
-        new_cable_rst = "%s_cable_rst_%d.nc" % (self.experiment_id, number)
-        new_cable_rst = os.path.join(self.restart_dir, new_cable_rst)
-        shutil.copy(cable_rst_ofname, new_cable_rst)
-
-        casa_rst_ofname = "%s_casa_rst_%d.nc" % (old_experiment_id, number)
-        casa_rst_ofname = os.path.join(self.restart_dir, casa_rst_ofname)
-        new_casa_rst = "%s_casa_rst_%d.nc" % (self.experiment_id, number)
-        new_casa_rst = os.path.join(self.restart_dir, new_casa_rst)
-        shutil.copy(casa_rst_ofname, new_casa_rst)
-
-    def initialise_stuff(self):
-
-        if not os.path.exists(self.restart_dir):
-            os.makedirs(self.restart_dir)
-
-        if not os.path.exists(self.output_dir):
-            os.makedirs(self.output_dir)
-
-        if not os.path.exists(self.log_dir):
-            os.makedirs(self.log_dir)
-
-        if not os.path.exists(self.namelist_dir):
-            os.makedirs(self.namelist_dir)
-
-        if not os.path.exists(self.dump_dir):
-            os.makedirs(self.dump_dir)
-
-        # Run all the met files in the directory
-        if len(self.met_subset) == 0:
-            met_files = glob.glob(os.path.join(self.met_dir, "*.nc"))
-        else:
-            met_files = [os.path.join(self.met_dir, i) for i in self.met_subset]
-
-        cwd = os.getcwd()
-        (url, rev) = get_svn_info(cwd, self.cable_src)
+    def run_analytical_spin(self, st_yr, en_yr, num, phase):
+        """
+        Analytical soil spin from the last restart. If we've just resumed
+        there won't be any CASA dumps in the working dir yet, so do a normal
+        spin first to make them.
+        """
+        if not self.have_dumps:
+            self.run_spin(num, phase)
+            num += 1
 
-        # delete local executable, copy a local copy and use that
-        local_exe = "cable"
-        if os.path.isfile(local_exe):
-            os.remove(local_exe)
-        shutil.copy(self.cable_exe, local_exe)
-        self.cable_exe = local_exe
+        self.check_abort()
+        self.setup_analytical_spin(st_yr, en_yr, number=num)
+        self.spin_control.count_run()
+        self.run_me()
+        self.clean_up(num, tag="spin_analytic")
+        self.record_run(num, "aspin", phase)
+        self.save_state(phase, num-1)
 
-        return (met_files, url, rev)
+        return num
 
     def inital_spin_setup(self, site, met_fname, sci_config, number=None):
         """
@@ -475,7 +364,7 @@ class RunCable(object):
         if bool(sci_config):
             replace_dict = merge_two_dicts(replace_dict, sci_config)
 
-        adjust_nml_file(self.nml_fname, replace_dict)
+        self.write_nml(replace_dict, "spin", number)
 
     def setup_spin(self, number=None, labile=True):
         """
@@ -524,7 +413,7 @@ class RunCable(object):
                         "leaps": ".TRUE.",
                         "cable_user%limit_labile": "%s" % (restrict_labile),
         }
-        adjust_nml_file(self.nml_fname, replace_dict)
+        self.write_nml(replace_dict, "spin", number)
         print(self.nml_fname)
 
     def setup_analytical_spin(self, st_yr, en_yr, labile=True, number=None):
@@ -568,7 +457,7 @@ class RunCable(object):
                         "leaps": ".TRUE.",
 
         }
-        adjust_nml_file(self.nml_fname, replace_dict)
+        self.write_nml(replace_dict, "aspin", number)
 
 
     def setup_simulation(self, met_fname, historical=True, number=None):
@@ -635,58 +524,12 @@ class RunCable(object):
                         "cable_user%limit_labile": ".FALSE.",
 
         }
-        adjust_nml_file(self.nml_fname, replace_dict)
-
-        return (out_fname)
-
-    def clean_up(self, number, tag):
-
-        # CASA out file is hardwired!
-        fname = glob.glob("*_casa_out.nc")
-        if len(fname) > 0:
-            if number is None:
-                out_fname = "%s_out_casa_%s.nc" % \
-                                    (self.experiment_id, tag)
-            else:
-                out_fname = "%s_out_casa_%s_%d.nc" % \
-                                    (self.experiment_id, tag, number)
-            shutil.move(fname[0], os.path.join(self.output_dir, out_fname))
-
-        f = "cnpfluxOut.csv"
-        if os.path.isfile(f):
-            os.remove(f)
-
-        f = "new_sumbal"
-        if os.path.isfile(f):
-            os.remove(f)
-
-        if tag == "simulation":
-            for f in glob.glob("c2c_*_dump.nc"):
-                shutil.move(f, os.path.join(self.dump_dir, f))
-
-    def run_me(self):
-        # run the model
-        if self.verbose:
-            cmd = './%s %s' % (self.cable_exe, self.nml_fname)
-            print(cmd)
-            error = subprocess.call(cmd, shell=True)
-            if error is 1:
-                print("Job failed to submit")
-                raise
+        if historical:
+            self.write_nml(replace_dict, "historical")
         else:
-            # No outputs to the screen: stout and stderr to dev/null
-            cmd = './%s %s > /dev/null 2>&1' % (self.cable_exe, self.nml_fname)
-            error = subprocess.call(cmd, shell=True)
-            if error is 1:
-                print("Job failed to submit")
-
-    def get_met_years(self, met_fname):
-
-        ds = xr.open_dataset(met_fname)
-        st_yr = pd.to_datetime(ds.time[0].values).year
-        en_yr = pd.to_datetime(ds.time[-1].values).year #- 1
+            self.write_nml(replace_dict, "simulation")
 
-        return (st_yr, en_yr)
+        return (out_fname)
 
 def merge_two_dicts(x, y):
     """Given two dicts, merge them into a new dict as a shallow copy."""
@@ -727,6 +570,21 @@ if __name__ == "__main__":
         C.main(sci_config)
     """
 
+    """
+    # Or spin each site up through C -> CN -> CNP in one go, each cycle
+    # starting from the last one's converged restart. Each cycle's ELE run
+    # starts from the AMB spin-up, and the next cycle starts speculatively
+    # once the soil check is within 10 x tol.
+    C = RunCable(met_dir=met_dir, log_dir=log_dir, output_dir=output_dir,
+                 dump_dir=dump_dir, restart_dir=restart_dir,
+                 aux_dir=aux_dir, namelist_dir=namelist_dir,
+                 met_subset=met_subset, cable_src=cable_src, mpi=mpi,
+                 num_cores=num_cores, biogeochem="C",
+                 co2_ndep_dir=co2_ndep_dir, speculate=10.0)
+    C.pipeline(sci_config, cycles=["C", "CN", "CNP"],
+               forcings=["AMB", "ELE"])
+    """
+
     """
     dont_have_restart = True
     for biogeochem in ["C"]:
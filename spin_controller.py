@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+
+"""
+Decide how many spin cycles to run between steady-state checks, rather than
+a fixed batch of 3 (or 5) each time round the loop.
+
+After each check we have the distance from steady state (delta) and the
+tolerance it has to get under. Two checks in a phase give the rate the
+pools are approaching steady state per run, assuming the approach is roughly
+geometric, delta_n = delta_0 * q**n, and from that the number of runs
+needed to get under the tolerance, i.e.
+
+    n = log(tol / delta) / log(q)
+
+clipped to [min_batch, max_batch]. Until we have a rate, or if the pools
+aren't getting any closer, the phase's default batch is used. Once a check
+passes no further runs are asked for. The checks themselves (Xia et al.
+2013) aren't changed, this only decides when they are made.
+
+Each phase can have its own tolerance, default batch and maximum number of
+checks, and the site has an overall budget of CABLE runs, e.g.
+
+    S = SpinController(phases={"soil_analytic": {"max_iterations": 40},
+                                "npp": {"batch": 2}},
+                       budget=500)
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import numpy as np
+
+
+class SpinLimitError(Exception):
+    pass
+
+
+class SpinAborted(Exception):
+    pass
+
+
+class SpinController(object):
+
+    def __init__(self, phases=None, min_batch=1, max_batch=10, budget=None):
+
+        # per phase settings: tol, batch, max_iterations
+        self.phases = phases if phases is not None else {}
+        self.min_batch = min_batch
+        self.max_batch = max_batch
+        self.budget = budget # CABLE runs per site, None for no limit
+        self.reset()
+
+    def reset(self):
+        """
+        Start a new site
+        """
+        self.runs = 0
+        self.start_phase(None)
+
+    def start_phase(self, phase, batch=3):
+        """
+        Start a spin phase; batch is what the phase runs between checks until
+        we know better
+        """
+        config = self.phases.get(phase, {})
+
+        self.phase = phase
+        self.batch = config.get("batch", batch)
+        self.tol = config.get("tol")  # None, use check_steady_state's
+        self.max_iterations = config.get("max_iterations")
+        self.checks = []              # (delta, tol, runs before the check)
+        self.rate_from = 0            # first check the rate can use
+        self.converged = False
+        self.runs_since_check = 0
+
+    def count_run(self):
+        """
+        Call for every CABLE run made for the site
+        """
+        self.runs += 1
+        self.runs_since_check += 1
+        if self.budget is not None and self.runs > self.budget:
+            raise SpinLimitError("%s: site budget of %d CABLE runs used up" %
+                                 (self.phase, self.budget))
+
+    def record(self, converged, delta, tol):
+        """
+        Call with the outcome of each steady-state check
+        """
+        self.checks.append((delta, tol, self.runs_since_check))
+        self.converged = converged
+        self.runs_since_check = 0
+
+        if (not converged and self.max_iterations is not None and
+            len(self.checks) >= self.max_iterations):
+            raise SpinLimitError("%s: not at steady state after %d checks, "
+                                 "delta=%g, tol=%g" %
+                                 (self.phase, len(self.checks), delta, tol))
+
+    def record_extrapolated(self, converged):
+        """
+        Call with the outcome of the check after the pools were extrapolated
+        (see accelerate_spin). They jumped there rather than spun, so that
+        check says nothing about the rate, which is worked out afresh from
+        the checks that follow.
+        """
+        self.converged = converged
+        self.runs_since_check = 0
+        self.rate_from = len(self.checks)
+
+    def rate(self):
+        """
+        Fraction of the distance from steady state that remains after each
+        run, from the last two checks, None if we can't tell yet
+        """
+        if len(self.checks) - self.rate_from < 2:
+            return None
+
+        (prev_delta, _, _) = self.checks[-2]
+        (delta, _, runs) = self.checks[-1]
+        if (runs == 0 or not np.isfinite(delta) or
+            not np.isfinite(prev_delta) or delta <= 0.0 or prev_delta <= 0.0):
+            return None
+
+        return (delta / prev_delta)**(1.0 / runs)
+
+    def next_batch(self):
+        """
+        Number of spins to run before the next check
+        """
+        if self.converged:
+            return 0
+        if len(self.checks) == 0:
+            return self.batch
+
+        (delta, tol, _) = self.checks[-1]
+        q = self.rate()
+        if q is None or q >= 1.0:
+            return self.batch
+        elif q == 0.0:
+            return self.min_batch
+
+        n = int(np.ceil(np.log(tol / delta) / np.log(q)))
+
+        return max(self.min_batch, min(self.max_batch, n))
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+
+"""
+A ledger of the spin-up: one row for every spin run (pool sizes, fluxes,
+forcing and runtime) and one for every steady-state check (delta, tolerance
+and whether it passed). Every site and cycle in a campaign appends to the
+same file, so the spin-up plots and convergence reports come from one small
+table rather than reopening every spin's output files.
+
+The ledger is a CSV with a fixed set of columns, appended to under a lock as
+several sites are run at once. To query it, e.g.
+
+    L = SpinLedger("logs/spin_ledger.csv")
+    df = L.read(site="AU-Tum", cycle="CNP", event="check")
+    print(L.convergence_report())
+
+or from the command line,
+
+    ./spin_ledger.py logs/spin_ledger.csv
+
+That's all folks.
+"""
+
+__author__ = "Martin De Kauwe"
+__version__ = "1.0 (18.10.2026)"
+__email__ = "mdekauwe@gmail.com"
+
+import os
+import sys
+import netCDF4
+import datetime as dt
+import numpy as np
+import pandas as pd
+
+from met_cache import FileLock
+
+
+class SpinLedger(object):
+
+    COLUMNS = ["time", "experiment_id", "site", "cycle", "phase",
+               "iteration", "event", "runtime",
+               "cf", "cw", "cr", "ca", "cs", "cp",
+               "co2", "ndep", "pdep", "gpp", "npp", "nep",
+               "delta", "tol", "converged"]
+
+    def __init__(self, fname):
+        self.fname = fname
+
+    def append(self, **row):
+        """
+        Add a row, columns not given are left empty
+        """
+        row["time"] = dt.datetime.now().isoformat(timespec="seconds")
+        values = []
+        for col in self.COLUMNS:
+            v = row.get(col)
+            if v is None or (isinstance(v, float) and np.isnan(v)):
+                values.append("")
+            elif isinstance(v, (float, np.floating)):
+                values.append("%.8g" % (v))
+            else:
+                values.append(str(v).replace(",", ";"))
+
+        with FileLock("%s.lock" % (self.fname)):
+            new_file = not os.path.isfile(self.fname)
+            with open(self.fname, "a") as f:
+                if new_file:
+                    f.write(",".join(self.COLUMNS) + "\n")
+                f.write(",".join(values) + "\n")
+
+    def read(self, **match):
+        """
+        The ledger as a DataFrame, optionally just the rows matching the
+        given column values, e.g. read(site="AU-Tum", phase="npp")
+        """
+        if not os.path.isfile(self.fname):
+            return pd.DataFrame(columns=self.COLUMNS)
+
+        df = pd.read_csv(self.fname)
+        for (col, value) in match.items():
+            if value is not None:
+                df = df[df[col] == value]
+
+        return df
+
+    def spin_history(self, site, cycle):
+        """
+        State at the end of each spin for a site and cycle, indexed by
+        iteration (the restart number). If a spin was run more than once
+        (e.g. after resuming) the last one is kept.
+        """
+        return self.history(site, cycle, "spin")
+
+    def check_history(self, site, cycle):
+        """
+        The steady-state checks for a site and cycle, with the pools that
+        were checked, indexed by iteration like spin_history
+        """
+        return self.history(site, cycle, "check")
+
+    def history(self, site, cycle, event):
+
+        df = self.read(site=site, cycle=cycle, event=event)
+        df = df.drop_duplicates(subset="iteration", keep="last")
+        df = df.sort_values("iteration")
+        df.index = df.iteration.values
+
+        return df
+
+    def convergence_report(self):
+        """
+        For each site, cycle and phase: the number of runs and checks made,
+        the CABLE time they took and where the last check got to
+        """
+        df = self.read()
+        keys = ["experiment_id", "cycle", "phase"]
+        runs = df[df.event != "check"].groupby(keys, sort=False)
+        checks = df[df.event == "check"].groupby(keys, sort=False)
+
+        report = pd.DataFrame({
+            "runs": runs.size(),
+            "runtime": runs.runtime.sum(),
+            "checks": checks.size(),
+            "delta": checks.delta.last(),
+            "tol": checks.tol.last(),
+            "converged": checks.converged.last(),
+        })
+        report.runs = report.runs.fillna(0).astype(int)
+        report.checks = report.checks.fillna(0).astype(int)
+
+        return report
+
+def read_run_diagnostics(casa_fname, cable_fname):
+    """
+    Annual fluxes and forcing of a spin run from its CASA and CABLE output
+    files, NaN for anything missing
+    """
+    diag = {"co2": np.nan, "ndep": np.nan, "pdep": np.nan, "gpp": np.nan,
+            "npp": np.nan, "nep": np.nan}
+
+    if os.path.isfile(casa_fname):
+        ds = netCDF4.Dataset(casa_fname)
+        for (key, var, last) in [("ndep", "Nmindep", True),
+                                 ("pdep", "Pdep", True),
+                                 ("gpp", "Cgpp", False),
+                                 ("npp", "Cnpp", False),
+                                 ("nep", "Cnep", False)]:
+            if var in ds.variables:
+                x = np.ma.filled(ds.variables[var][:, 0], np.nan)
+                diag[key] = x[-1] if last else np.mean(x)
+        ds.close()
+
+    if os.path.isfile(cable_fname):
+        ds = netCDF4.Dataset(cable_fname)
+        if "CO2air" in ds.variables:
+            co2 = np.ma.filled(ds.variables["CO2air"][-1], np.nan)
+            diag["co2"] = np.ravel(co2)[0]
+        ds.close()
+
+    return diag
+
+
+if __name__ == "__main__":
+
+    fname = "logs/spin_ledger.csv"
+    if len(sys.argv) > 1:
+        fname = sys.argv[1]
+
+    print(SpinLedger(fname).convergence_report().to_string())